@@ -6,7 +6,11 @@ version 2.0.0
 Andy Hobbs - 12/20/2025
 """
 
+import sys
+
 try:
+    import dns.inet
+    import dns.rdatatype
     import dns.resolver
 except ImportError:
     print("Error: 'dnspython' library is required.")
@@ -15,22 +19,37 @@ except ImportError:
     print("  2. User install: pip3 install --user dnspython")
     sys.exit(1)
 
+try:
+    import dns.nameserver  # DNS-over-TLS, dnspython 2.4 and later
+except ImportError:
+    pass
+
+import argparse
+import heapq
 import json
 import datetime
 import time
 import configparser
-import sys
 import os
+import queue
+import random
+import signal
+import statistics
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import urlparse, urljoin
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 try:
     import requests
+    import requests.adapters
 except ImportError:
     print("Error: 'requests' library is required. Install it with: pip install requests")
     sys.exit(1)
 
 
+RELOAD_CHECK_INTERVAL = 5  # seconds between checks for changed config files in daemon mode
+
+
 def read_dns_servers(config_file: str = 'dns_servers.txt') -> List[str]:
     """Read DNS server IPs from config file."""
     servers = []
@@ -48,29 +67,48 @@ def read_dns_servers(config_file: str = 'dns_servers.txt') -> List[str]:
             f.write("# 8.8.8.8\n")
             f.write("# 1.1.1.1\n")
             f.write("# 208.67.222.222\n")
+            f.write("# tcp://9.9.9.9\n")
+            f.write("# tls://1.1.1.1#cloudflare-dns.com\n")
+            f.write("# https://dns.google/dns-query\n")
     except Exception as e:
         print(f"Error reading DNS servers config file: {e}")
     
     return servers
 
 
-def read_domains(config_file: str = 'config.txt') -> List[str]:
-    """Read website URLs/domains from config file."""
+def read_domain_entries(config_file: str = 'config.txt') -> List[Tuple[str, Optional[float]]]:
+    """
+    Read website URLs/domains from config file, with their check interval.
+    
+    A line may end with an interval in seconds for daemon mode, e.g. 'example.com 60'.
+    Returns a list of (domain, interval) tuples, interval is None if not given.
+    """
     domains = []
     try:
         with open(config_file, 'r', encoding='utf-8') as f:
             for line in f:
                 line = line.strip()
                 if line and not line.startswith('#'):  # Skip empty lines and comments
+                    fields = line.split()
+                    interval = None
+                    if len(fields) > 1:
+                        try:
+                            interval = float(fields[1])
+                        except ValueError:
+                            pass
+                        if interval is None or not 0 < interval < float('inf'):
+                            interval = None
+                            print(f"Warning: Ignoring invalid interval '{fields[1]}' for {fields[0]}")
+                    
                     # Extract domain from URL if needed
-                    domain = line
+                    domain = fields[0]
                     if '://' in domain:
                         domain = domain.split('://')[1]
                     if '/' in domain:
                         domain = domain.split('/')[0]
                     if ':' in domain:
                         domain = domain.split(':')[0]
-                    domains.append(domain)
+                    domains.append((domain, interval))
     except FileNotFoundError:
         print(f"Warning: Config file '{config_file}' not found. Creating example config file.")
         with open(config_file, 'w', encoding='utf-8') as f:
@@ -79,15 +117,119 @@ def read_domains(config_file: str = 'config.txt') -> List[str]:
             f.write("# google.com\n")
             f.write("# https://www.example.com\n")
             f.write("# github.com\n")
+            f.write("# example.org 60   (checked every 60 seconds in daemon mode)\n")
     except Exception as e:
         print(f"Error reading config file: {e}")
     
     return domains
 
 
-def resolve_dns(domain: str, dns_server: str, timeout: int = 5) -> Dict[str, Any]:
+def read_domains(config_file: str = 'config.txt') -> List[str]:
+    """Read website URLs/domains from config file."""
+    return [domain for domain, _ in read_domain_entries(config_file)]
+
+
+class TcpResolver(dns.resolver.Resolver):
+    """Resolver that sends every query over TCP."""
+    
+    def resolve(self, *args, **kwargs):
+        kwargs['tcp'] = True
+        return super().resolve(*args, **kwargs)
+
+
+def split_address(address: str, default_port: int) -> Tuple[str, int]:
+    """Split 'address', 'address:port' or '[ipv6]:port' into address and port."""
+    if address.startswith('['):
+        host, _, port = address[1:].partition(']')
+        return host, int(port[1:]) if port else default_port
+    if address.count(':') == 1:
+        host, port = address.split(':')
+        return host, int(port)
+    return address, default_port
+
+
+def build_resolver(dns_server: str, timeout: float = 5) -> dns.resolver.Resolver:
+    """
+    Create a resolver that only queries dns_server.
+    
+    The transport is picked by the form of dns_server:
+      8.8.8.8 or udp://8.8.8.8           UDP, retried over TCP if the answer is truncated
+      tcp://8.8.8.8[:port]               TCP only
+      tls://1.1.1.1[:port][#hostname]    DNS-over-TLS, hostname verifies the certificate
+      https://dns.google/dns-query       DNS-over-HTTPS, needs the httpx module
+    
+    Resolvers are built once per DNS server and shared by all lookups against it,
+    so a lookup does not re-read /etc/resolv.conf or set up a resolver first.
+    They keep no cache, so every lookup goes to the DNS server.
+    
+    Raises ValueError if dns_server is not valid.
+    """
+    scheme, _, address = dns_server.rpartition('://')
+    if scheme == 'tcp':
+        resolver = TcpResolver(configure=False)
+    else:
+        resolver = dns.resolver.Resolver(configure=False)
+    
+    if scheme in ('', 'udp', 'tcp'):
+        host, port = split_address(address, 53)
+        resolver.nameservers = [host]
+        resolver.port = port
+    elif scheme == 'tls':
+        if not hasattr(dns, 'nameserver'):
+            raise ValueError('DNS-over-TLS needs dnspython 2.4 or later')
+        address, _, hostname = address.partition('#')
+        host, port = split_address(address, 853)
+        dns.inet.af_for_address(host)  # raises ValueError for anything but an IP address
+        resolver.nameservers = [dns.nameserver.DoTNameserver(host, port, hostname=hostname or None)]
+    elif scheme == 'https':
+        resolver.nameservers = [dns_server]
+    else:
+        raise ValueError(f"unknown transport '{scheme}'")
+    resolver.timeout = timeout
+    resolver.lifetime = timeout
+    return resolver
+
+
+def combine_results(results: Dict[str, Dict[str, Any]], rdtypes: List[str]) -> Dict[str, Any]:
     """
-    Resolve DNS for a given domain using a specific DNS server.
+    Combine the results of the record types queried for one domain into one record.
+    
+    The fields of the A query (or of the first type queried) stay at the top level as
+    before, and records holds the result of every type, with its own latencies.
+    """
+    if rdtypes == ['A']:
+        return results['A']
+    
+    primary = results['A' if 'A' in results else rdtypes[0]]
+    combined = dict(primary)
+    combined['timestamp'] = min(result['timestamp'] for result in results.values())
+    combined['resolved_ip'] = primary['resolved_ip'] or results.get('AAAA', {}).get('resolved_ip')
+    combined['records'] = {
+        rdtype: {key: value for key, value in results[rdtype].items()
+                 if key not in ('timestamp', 'resolved_ip') and value not in (None, [])}
+        for rdtype in rdtypes
+    }
+    return combined
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    return values[max(0, -(-len(values) * percent // 100) - 1)]
+
+
+def resolve_dns(domain: str, resolver: dns.resolver.Resolver, samples: int = 1,
+                rdtype: str = 'A') -> Dict[str, Any]:
+    """
+    Resolve DNS for a given domain using a resolver from build_resolver().
+    
+    answers holds the text of the records in the answer and cname_chain the names the
+    query was redirected through by CNAME records, if any. resolved_ip is the first
+    answer of A and AAAA queries.
+    
+    With samples > 1 the domain is queried that many times and the result also holds
+    the min/median/p95/max resolution time over the answered queries and the loss rate,
+    the share of queries the DNS server did not answer. resolve_time_ms is the median.
+    NXDOMAIN and empty answers count as answered.
     
     Returns a dictionary with resolution information or error details.
     """
@@ -97,40 +239,60 @@ def resolve_dns(domain: str, dns_server: str, timeout: int = 5) -> Dict[str, Any
         'timestamp': datetime.datetime.now().isoformat(),
         'error': None
     }
+    times = []
+    lost = 0
     
-    try:
-        # Create resolver with specific DNS server
-        resolver = dns.resolver.Resolver()
-        resolver.nameservers = [dns_server]
-        resolver.timeout = timeout
-        resolver.lifetime = timeout
-        
-        # Measure resolution time
-        start_time = time.time()
-        answers = resolver.resolve(domain, 'A')
-        end_time = time.time()
-        
-        # Calculate resolution time in milliseconds
-        resolve_time_ms = round((end_time - start_time) * 1000, 2)
-        
-        # Get the first IP address (primary)
-        resolved_ip = str(answers[0])
-        
-        result['resolved_ip'] = resolved_ip
-        result['resolve_time_ms'] = resolve_time_ms
-        
-    except dns.resolver.Timeout:
-        result['error'] = f'DNS query timeout after {timeout} seconds'
-    except dns.resolver.NXDOMAIN:
-        result['error'] = 'Domain does not exist (NXDOMAIN)'
-    except dns.resolver.NoAnswer:
-        result['error'] = 'No answer received from DNS server'
-    except dns.resolver.NoNameservers:
-        result['error'] = 'No nameservers available'
-    except dns.exception.DNSException as e:
-        result['error'] = f'DNS error: {str(e)}'
-    except Exception as e:
-        result['error'] = f'Unexpected error: {str(e)}'
+    for _ in range(samples):
+        # Measure resolution time with a monotonic clock, NTP adjustments do not affect it
+        start_time = time.perf_counter()
+        try:
+            answers = resolver.resolve(domain, rdtype)
+            times.append((time.perf_counter() - start_time) * 1000)
+            
+            if 'answers' not in result:
+                result['answers'] = [rdata.to_text() for rdata in answers]
+                result['cname_chain'] = [rrset[0].target.to_text(omit_final_dot=True)
+                                         for rrset in answers.chaining_result.cnames]
+                result['error'] = None
+            
+            # Get the first IP address (primary)
+            if result['resolved_ip'] is None and rdtype in ('A', 'AAAA'):
+                result['resolved_ip'] = str(answers[0])
+                
+        except dns.resolver.NXDOMAIN:
+            times.append((time.perf_counter() - start_time) * 1000)
+            result['error'] = 'Domain does not exist (NXDOMAIN)'
+        except dns.resolver.NoAnswer:
+            times.append((time.perf_counter() - start_time) * 1000)
+            result['error'] = 'No answer received from DNS server'
+        except dns.resolver.Timeout:
+            lost += 1
+            result['error'] = f'DNS query timeout after {resolver.lifetime:g} seconds'
+        except dns.resolver.NoNameservers:
+            lost += 1
+            result['error'] = 'No nameservers available'
+        except dns.exception.DNSException as e:
+            lost += 1
+            result['error'] = f'DNS error: {str(e)}'
+        except Exception as e:
+            lost += 1
+            result['error'] = f'Unexpected error: {str(e)}'
+    
+    if 'answers' in result:
+        result['error'] = None
+    
+    if times:
+        times.sort()
+        result['resolve_time_ms'] = round(statistics.median(times), 2)
+    
+    if samples > 1:
+        result['samples'] = samples
+        result['loss_rate'] = round(lost / samples, 4)
+        if times:
+            result['resolve_time_min_ms'] = round(times[0], 2)
+            result['resolve_time_median_ms'] = round(statistics.median(times), 2)
+            result['resolve_time_p95_ms'] = round(percentile(times, 95), 2)
+            result['resolve_time_max_ms'] = round(times[-1], 2)
     
     return result
 
@@ -206,19 +368,26 @@ def load_api_config(config_file: str = 'api_config.ini') -> Dict[str, str]:
         sys.exit(1)
 
 
-def update_dns_lookup_via_api(api_url: str, api_token: str, domain: str, dns_server: str,
-                               result: Dict[str, Any]) -> bool:
+def create_api_session(api_token: str, pool_size: int = 4) -> requests.Session:
     """
-    Update DNS lookup data via LibreNMS API.
+    Create an HTTP session for the LibreNMS API.
     
-    Returns True if successful, False otherwise.
+    The session keeps connections alive between requests, so the TCP and TLS
+    handshakes are paid once per run instead of once per lookup.
     """
-    endpoint = urljoin(api_url, '/api/v0/enhanced/dns_lookup')
-    headers = {
+    session = requests.Session()
+    session.headers.update({
         'X-Auth-Token': api_token,
         'Content-Type': 'application/json'
-    }
-    
+    })
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def build_payload(domain: str, dns_server: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the API record for one lookup."""
     # Prepare payload - map error to error_message
     payload = {
         'domain': domain,
@@ -232,11 +401,30 @@ def update_dns_lookup_via_api(api_url: str, api_token: str, domain: str, dns_ser
     if 'error' in result:
         payload['error_message'] = result['error']
     
+    # Multi-sample statistics, only present with more than one sample
+    for key in ('samples', 'loss_rate', 'resolve_time_min_ms', 'resolve_time_median_ms',
+                'resolve_time_p95_ms', 'resolve_time_max_ms'):
+        payload[key] = result.get(key)
+    
+    # Results per record type, only present when other types than A are queried
+    payload['records'] = result.get('records')
+    
     # Remove None values
-    payload = {k: v for k, v in payload.items() if v is not None}
+    return {k: v for k, v in payload.items() if v is not None}
+
+
+def post_to_api(session: requests.Session, endpoint: str, body: Any,
+                unsupported: tuple = ()) -> Optional[bool]:
+    """
+    POST body to an API endpoint.
     
+    Returns True if successful, False otherwise, or None if the response status is
+    one of the unsupported ones.
+    """
     try:
-        response = requests.post(endpoint, headers=headers, json=payload, timeout=30)
+        response = session.post(endpoint, json=body, timeout=30)
+        if response.status_code in unsupported:
+            return None
         response.raise_for_status()
         
         data = response.json()
@@ -267,17 +455,406 @@ def update_dns_lookup_via_api(api_url: str, api_token: str, domain: str, dns_ser
         return False
 
 
+def update_dns_lookup_via_api(session: requests.Session, api_url: str, domain: str, dns_server: str,
+                               result: Dict[str, Any]) -> bool:
+    """
+    Update DNS lookup data via LibreNMS API.
+    
+    Returns True if successful, False otherwise.
+    """
+    endpoint = urljoin(api_url, '/api/v0/enhanced/dns_lookup')
+    return bool(post_to_api(session, endpoint, build_payload(domain, dns_server, result)))
+
+
+def update_dns_lookups_via_api(session: requests.Session, api_url: str,
+                               lookups: List[tuple]) -> Optional[bool]:
+    """
+    Update many DNS lookups with a single request to the batch endpoint.
+    
+    lookups is a list of (domain, dns_server, result) tuples, sent as
+    {"lookups": [record, ...]}. Returns True if successful, False otherwise,
+    or None if the API has no batch endpoint.
+    """
+    endpoint = urljoin(api_url, '/api/v0/enhanced/dns_lookup/batch')
+    body = {'lookups': [build_payload(*lookup) for lookup in lookups]}
+    return post_to_api(session, endpoint, body, unsupported=(404, 405))
+
+
+def print_result(domain: str, dns_server: str, result: Dict[str, Any]):
+    """Print the outcome of one lookup."""
+    if result['error']:
+        print(f"{domain} via {dns_server}: ✗ Error: {result['error']}")
+    else:
+        print(f"{domain} via {dns_server}: ✓ {result['resolved_ip']} ({result['resolve_time_ms']}ms)")
+    
+    if 'loss_rate' in result and 'records' not in result:
+        print_samples(result)
+    
+    for rdtype, record in result.get('records', {}).items():
+        if 'error' in record:
+            print(f"  {rdtype}: ✗ {record['error']}")
+        else:
+            chain = ''.join(f" → {name}" for name in record.get('cname_chain', []))
+            print(f"  {rdtype}{chain}: {', '.join(record['answers'])} ({record['resolve_time_ms']}ms)")
+        if 'loss_rate' in record:
+            print_samples(record, '    ')
+
+
+def print_samples(result: Dict[str, Any], indent: str = '  '):
+    """Print the multi-sample statistics of a result."""
+    if 'resolve_time_min_ms' in result:
+        print(f"{indent}min/median/p95/max {result['resolve_time_min_ms']}/{result['resolve_time_median_ms']}/"
+              f"{result['resolve_time_p95_ms']}/{result['resolve_time_max_ms']}ms, "
+              f"loss {result['loss_rate']:.0%} of {result['samples']}")
+    else:
+        print(f"{indent}loss {result['loss_rate']:.0%} of {result['samples']}")
+
+
+class ResultStore:
+    """
+    Collects lookup results and stores them via the API in batches.
+    
+    Falls back to storing results one at a time if the API has no batch endpoint.
+    """
+    
+    def __init__(self, session: requests.Session, api_url: str, batch_size: int):
+        self.session = session
+        self.api_url = api_url
+        self.batch_size = batch_size
+        self.use_batch = batch_size > 1
+        self.pending = []
+        self.success_count = 0
+        self.fail_count = 0
+    
+    def add(self, lookup: tuple):
+        self.pending.append(lookup)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+    
+    def flush(self):
+        lookups, self.pending = self.pending, []
+        if not lookups:
+            return
+        
+        if self.use_batch:
+            stored = update_dns_lookups_via_api(self.session, self.api_url, lookups)
+            if stored is not None:
+                if stored:
+                    self.success_count += len(lookups)
+                else:
+                    self.fail_count += len(lookups)
+                    print(f"  Failed to store {len(lookups)} result(s) via API")
+                return
+            print("  API has no batch endpoint, storing results one at a time")
+            self.use_batch = False
+        
+        for domain, dns_server, result in lookups:
+            if update_dns_lookup_via_api(self.session, self.api_url, domain, dns_server, result):
+                self.success_count += 1
+            else:
+                self.fail_count += 1
+                print(f"  Failed to store {domain} via {dns_server} via API")
+    
+    def close(self):
+        self.flush()
+        self.session.close()
+
+
+def build_resolvers(dns_servers: List[str], timeout: float,
+                    resolvers: Optional[Dict[str, dns.resolver.Resolver]] = None) -> Dict[str, dns.resolver.Resolver]:
+    """Build one resolver per DNS server, reusing the ones in resolvers."""
+    resolvers = resolvers or {}
+    built = {}
+    for dns_server in dns_servers:
+        if dns_server in resolvers:
+            built[dns_server] = resolvers[dns_server]
+            continue
+        try:
+            built[dns_server] = build_resolver(dns_server, timeout)
+        except ValueError as e:
+            print(f"Warning: Skipping invalid DNS server '{dns_server}': {e}")
+    return built
+
+
+class LookupPool:
+    """
+    Runs lookups concurrently, on a pool of worker threads per DNS server.
+    
+    Each DNS server gets its own pool of at most per_server worker threads, so a slow
+    or unreachable server only holds up its own lookups and no server is sent more
+    than per_server queries at a time. The record types of a domain are queried
+    concurrently too, and combined by combine_results() once all are done.
+    """
+    
+    def __init__(self, per_server: int, samples: int = 1, rdtypes: Optional[List[str]] = None):
+        self.per_server = per_server
+        self.samples = samples
+        self.rdtypes = rdtypes or ['A']
+        self.executors = {}  # dns_server -> ThreadPoolExecutor
+        self.lookups = {}  # future -> (domain, dns_server, rdtype)
+        self.results = {}  # (domain, dns_server) -> {rdtype: result}, for checks in flight
+        self.done = queue.Queue()
+    
+    def submit(self, domain: str, resolvers: Dict[str, dns.resolver.Resolver]):
+        """
+        Start checking domain against every DNS server in resolvers.
+        
+        Servers the domain is still being checked on are skipped.
+        """
+        for dns_server, resolver in resolvers.items():
+            if (domain, dns_server) in self.results:
+                continue
+            if dns_server not in self.executors:
+                self.executors[dns_server] = ThreadPoolExecutor(max_workers=self.per_server)
+            self.results[(domain, dns_server)] = {}
+            for rdtype in self.rdtypes:
+                future = self.executors[dns_server].submit(resolve_dns, domain, resolver, self.samples, rdtype)
+                self.lookups[future] = (domain, dns_server, rdtype)
+                future.add_done_callback(self.done.put)
+    
+    def completed(self, timeout: Optional[float] = None):
+        """
+        Wait up to timeout seconds for lookups to finish, forever if None.
+        
+        Yields (domain, dns_server, result) for every domain that is done on a server.
+        """
+        try:
+            future = self.done.get(timeout=timeout)
+        except queue.Empty:
+            return
+        
+        while True:
+            domain, dns_server, rdtype = self.lookups.pop(future)
+            results = self.results[(domain, dns_server)]
+            results[rdtype] = future.result()
+            if len(results) == len(self.rdtypes):
+                del self.results[(domain, dns_server)]
+                yield domain, dns_server, combine_results(results, self.rdtypes)
+            
+            try:
+                future = self.done.get_nowait()
+            except queue.Empty:
+                return
+    
+    def retire(self, dns_servers: List[str]):
+        """Stop the pools of DNS servers not in dns_servers once their lookups are done."""
+        for dns_server in list(self.executors):
+            if dns_server not in dns_servers:
+                self.executors.pop(dns_server).shutdown(wait=False)
+    
+    def close(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def check_all(domains: List[str], resolvers: Dict[str, dns.resolver.Resolver], per_server: int,
+              samples: int = 1, rdtypes: Optional[List[str]] = None):
+    """
+    Resolve every domain against every DNS server concurrently.
+    
+    Yields (domain, dns_server, result) as soon as all record types of a domain are
+    done on a server. See LookupPool.
+    """
+    pool = LookupPool(per_server, samples, rdtypes)
+    try:
+        for domain in domains:
+            pool.submit(domain, resolvers)
+        while pool.lookups:
+            yield from pool.completed()
+    finally:
+        pool.close()
+
+
+def file_mtimes(paths: List[Path]) -> List[Optional[float]]:
+    """Modification times of paths, None for missing files."""
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(path.stat().st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+def run_daemon(args: argparse.Namespace, config_file: str, dns_servers_file: str, domains_file: str):
+    """
+    Check domains on a schedule until stopped.
+    
+    Each domain is checked every interval seconds, from its line in the domains file or
+    --interval, varied by up to --jitter of the interval so checks do not bunch up.
+    Checks are started as soon as they are due, without waiting for earlier checks
+    to finish, so a slow or dead DNS server does not delay the other checks. A DNS
+    server a domain is still being checked on when it is due again is skipped that
+    time. The config files are reloaded when they change. Resolvers, their worker
+    threads and the API session are kept between checks.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    watched = [Path(__file__).parent.absolute() / config_file, Path(config_file),
+               Path(dns_servers_file), Path(domains_file)]
+    mtimes = None
+    api_config = None
+    store = None
+    resolvers = {}
+    intervals = {}  # domain -> seconds between checks
+    next_due = {}  # domain -> monotonic time of its next check
+    schedule = []  # heap of (due, domain), entries not matching next_due are stale
+    next_reload_check = 0.0
+    pool = LookupPool(args.per_server, args.samples, args.types)
+    
+    try:
+        while True:
+            now = time.monotonic()
+            
+            if now >= next_reload_check:
+                next_reload_check = now + RELOAD_CHECK_INTERVAL
+                if store:
+                    store.flush()
+                current_mtimes = file_mtimes(watched)
+                if current_mtimes != mtimes:
+                    mtimes = current_mtimes
+                    
+                    try:
+                        new_api_config = load_api_config(config_file)
+                    except SystemExit:
+                        if store is None:
+                            raise
+                        print("Keeping the previous API configuration")
+                        new_api_config = api_config
+                    if new_api_config != api_config:
+                        if store:
+                            store.close()
+                        api_config = new_api_config
+                        store = ResultStore(create_api_session(api_config['token']), api_config['url'],
+                                            args.batch_size)
+                    
+                    resolvers = build_resolvers(read_dns_servers(dns_servers_file), args.timeout, resolvers)
+                    pool.retire(list(resolvers))
+                    
+                    intervals = {domain: interval or args.interval
+                                 for domain, interval in read_domain_entries(domains_file)}
+                    for domain in list(next_due):
+                        if domain not in intervals:
+                            del next_due[domain]
+                    for domain, interval in intervals.items():
+                        if domain not in next_due:
+                            # spread the first checks out instead of starting them all at once
+                            next_due[domain] = now + random.uniform(0, args.jitter * interval)
+                            heapq.heappush(schedule, (next_due[domain], domain))
+                    
+                    print(f"Loaded {len(intervals)} domain(s) and {len(resolvers)} DNS server(s)")
+            
+            while schedule and schedule[0][0] <= now:
+                due_time, domain = heapq.heappop(schedule)
+                if next_due.get(domain) != due_time:
+                    continue
+                
+                pool.submit(domain, resolvers)
+                # scheduled from when the check was due, so the time checks take does not add
+                # up, unless the daemon fell more than an interval behind
+                interval = intervals[domain] * (1 + random.uniform(-args.jitter, args.jitter))
+                next_due[domain] = due_time + interval
+                if next_due[domain] <= now:
+                    next_due[domain] = now + interval
+                heapq.heappush(schedule, (next_due[domain], domain))
+            
+            wake_up = min(schedule[0][0] if schedule else next_reload_check, next_reload_check)
+            for lookup in pool.completed(max(0.0, wake_up - now)):
+                print_result(*lookup)
+                store.add(lookup)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # SystemExit is passed on, so a bad config at startup still exits with an error
+        pool.close()
+        if store:
+            store.close()
+        print("DNS resolution checker stopped.")
+
+
+def record_types(value: str) -> List[str]:
+    """Parse and validate a comma separated list of record types."""
+    rdtypes = []
+    for rdtype in value.upper().split(','):
+        try:
+            dns.rdatatype.from_text(rdtype.strip())
+        except dns.rdatatype.UnknownRdatatype:
+            raise argparse.ArgumentTypeError(f"unknown record type '{rdtype}'")
+        if rdtype.strip() not in rdtypes:
+            rdtypes.append(rdtype.strip())
+    return rdtypes
+
+
+def positive_int(value: str) -> int:
+    """Parse an integer of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+    return number
+
+
+def positive_float(value: str) -> float:
+    """Parse a number greater than 0."""
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid float value: '{value}'")
+    if not 0 < number < float('inf'):
+        raise argparse.ArgumentTypeError(f"must be greater than 0, not {value}")
+    return number
+
+
+def share(value: str) -> float:
+    """Parse a share of at least 0 and less than 1."""
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid float value: '{value}'")
+    if not 0 <= number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 0 and less than 1, not {value}")
+    return number
+
+
 def main():
     """Main function to orchestrate DNS resolution checking via LibreNMS API."""
+    parser = argparse.ArgumentParser(description='Check DNS resolution times and store them via the LibreNMS API.')
+    parser.add_argument('--per-server', type=positive_int, default=16,
+                        help='Maximum number of concurrent lookups per DNS server (default: 16)')
+    parser.add_argument('--timeout', type=float, default=5,
+                        help='Seconds to wait for a DNS answer (default: 5)')
+    parser.add_argument('--samples', type=positive_int, default=1,
+                        help='Queries per domain and DNS server, more than 1 also reports '
+                             'min/median/p95/max times and the loss rate (default: 1)')
+    parser.add_argument('--types', type=record_types, default=['A'],
+                        help='Comma separated record types to query, e.g. A,AAAA,CNAME,MX,NS,SOA. With more '
+                             'than A, the results of every type are stored in one record (default: A)')
+    parser.add_argument('--batch-size', type=int, default=200,
+                        help='Results to store per API request, 1 stores each result on its own (default: 200)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and check each domain on a schedule, reloading the config files '
+                             'when they change')
+    parser.add_argument('--interval', type=positive_float, default=60,
+                        help='Seconds between checks of a domain in daemon mode, unless its line in the '
+                             'domains file sets one (default: 60)')
+    parser.add_argument('--jitter', type=share, default=0.1,
+                        help='Vary each interval randomly by up to this share of it, less than 1 (default: 0.1)')
+    args = parser.parse_args()
+    
     config_file = 'api_config.ini'
     dns_servers_file = 'dns_servers.txt'
     domains_file = 'config.txt'
     
+    if args.daemon:
+        run_daemon(args, config_file, dns_servers_file, domains_file)
+        return
+    
     # Load API configuration
     print(f"Loading API configuration from '{config_file}'...")
     api_config = load_api_config(config_file)
-    api_url = api_config['url']
-    api_token = api_config['token']
+    store = ResultStore(create_api_session(api_config['token']), api_config['url'], args.batch_size)
     
     # Read DNS servers from config file
     dns_servers = read_dns_servers(dns_servers_file)
@@ -286,6 +863,9 @@ def main():
         print("No DNS servers found in config file. Please add DNS server IPs to check.")
         return
     
+    # Build one resolver per DNS server, shared by all lookups against it
+    resolvers = build_resolvers(dns_servers, args.timeout)
+    
     # Read domains from config file
     domains = read_domains(domains_file)
     
@@ -294,39 +874,17 @@ def main():
         return
     
     # Check DNS resolution for each domain against each DNS server
-    print(f"Checking DNS resolution for {len(domains)} domain(s) using {len(dns_servers)} DNS server(s)...")
-    success_count = 0
-    fail_count = 0
-    
-    for dns_server in dns_servers:
-        print(f"\nUsing DNS server: {dns_server}")
-        
-        for domain in domains:
-            print(f"Checking {domain} via {dns_server}...", end=' ', flush=True)
-            
-            # Resolve DNS
-            result = resolve_dns(domain, dns_server)
-            
-            # Update via API
-            if update_dns_lookup_via_api(api_url, api_token, domain, dns_server, result):
-                success_count += 1
-                # Print status
-                if result['error']:
-                    print(f"✗ Error: {result['error']}")
-                else:
-                    print(f"✓ {result['resolved_ip']} ({result['resolve_time_ms']}ms)")
-            else:
-                fail_count += 1
-                if result['error']:
-                    print(f"✗ Error: {result['error']} (API update failed)")
-                else:
-                    print(f"✗ {result['resolved_ip']} ({result['resolve_time_ms']}ms) (API update failed)")
+    print(f"Checking DNS resolution for {len(domains)} domain(s) using {len(resolvers)} DNS server(s)...")
+    for lookup in check_all(domains, resolvers, args.per_server, args.samples, args.types):
+        print_result(*lookup)
+        store.add(lookup)
+    store.close()
     
     # Summary
     print(f"\nDNS resolution check complete.")
-    print(f"  Successfully updated: {success_count}")
-    if fail_count > 0:
-        print(f"  Failed to update: {fail_count}")
+    print(f"  Successfully updated: {store.success_count}")
+    if store.fail_count > 0:
+        print(f"  Failed to update: {store.fail_count}")
 
 
 if __name__ == '__main__':
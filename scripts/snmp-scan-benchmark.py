@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Benchmark snmp-scan.py without touching real networks or a LibreNMS install
+
+Runs snmp-scan.py over synthetic ranges with a stand-in for lnms device:add and
+snmp-scan-add.php, answering with configurable latencies and exit codes, and a
+stand-in resolver answering reverse and forward lookups. Reports hosts per second,
+the peak RSS of the scanner and all its child processes together, and the latency
+percentiles per outcome.
+
+The stand-ins are this script itself, linked as lnms and php into a temporary
+directory put first in PATH. Options that send packets, like --snmp-probe and
+--subnet-check, still do, so keep the default benchmarking range (RFC 2544) for them.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+@package    LibreNMS
+@link       https://www.librenms.org
+"""
+
+import argparse
+import json
+import random
+import resource
+import runpy
+import shlex
+import socket
+import sys
+import zlib
+from ipaddress import ip_address
+from os import environ, listdir, path, symlink
+from subprocess import DEVNULL, Popen
+from tempfile import TemporaryDirectory
+from time import monotonic, sleep
+
+SCANNER = path.join(path.dirname(path.dirname(path.realpath(__file__))), "snmp-scan.py")
+DOMAIN = ".bench.invalid"
+PAGE_SIZE = resource.getpagesize()
+REAL_GETADDRINFO = socket.getaddrinfo
+
+
+def settings():
+    return json.loads(environ["SNMP_SCAN_BENCHMARK"])
+
+
+def fraction(salt, key):
+    """A stable pseudo random number in [0, 1) for key"""
+    return zlib.crc32("{}:{}".format(salt, key).encode()) / 2**32
+
+
+def jittered(latency, jitter):
+    return max(0.0, latency * (1 + random.uniform(-jitter, jitter)))
+
+
+def host_address(host):
+    """The address a fake hostname was made from, or host itself"""
+    if host.endswith(DOMAIN):
+        return str(ip_address(bytes.fromhex(host[1 : -len(DOMAIN)])))
+    return host
+
+
+##############
+# Stand-ins #
+##############
+
+
+def device_add(host):
+    """Returns (exit code, output) for a device:add of host, the same for every run"""
+    bench = settings()
+    chance = fraction("add", host_address(host))
+
+    for code, output, share in [
+        (0, "Added device {}", bench["added"]),
+        (3, "Already have host {}", bench["known"]),
+        (2, "Failed to add {}: no SNMP response", bench["failed"]),
+        (1, "Error adding {}", bench["error"]),
+    ]:
+        if chance < share:
+            sleep(jittered(bench["add_latency"], bench["jitter"]))
+            return code, output.format(host)
+        chance -= share
+
+    sleep(jittered(bench["down_latency"], bench["jitter"]))
+    return 2, "Could not ping {}".format(host)
+
+
+def fake_lnms(arguments):
+    if arguments[:1] == ["config:get"]:
+        print(json.dumps(settings()["config"]))
+        return 0
+
+    code, output = device_add(arguments[-1])
+    print(output)
+    return code
+
+
+def fake_php(arguments):
+    if arguments[:1] == ["lnms"]:
+        return fake_lnms(arguments[1:])
+
+    # snmp-scan-add.php, one host per line on stdin and one JSON reply per line
+    for line in sys.stdin:
+        host = line.strip()
+        code, output = device_add(host)
+        print(
+            json.dumps({"hostname": host, "status": code, "output": output}),
+            flush=True,
+        )
+    return 0
+
+
+def fake_getnameinfo(sockaddr, flags):
+    bench = settings()
+    sleep(jittered(bench["dns_latency"], bench["jitter"]))
+    if fraction("dns", sockaddr[0]) >= bench["dns_ratio"]:
+        raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+    return "h" + ip_address(sockaddr[0]).packed.hex() + DOMAIN, "0"
+
+
+def fake_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    if not host.endswith(DOMAIN):
+        # Redis, the database and anything else that is not a scanned host
+        return REAL_GETADDRINFO(host, port, family, type, proto, flags)
+
+    bench = settings()
+    sleep(jittered(bench["dns_latency"], bench["jitter"]))
+    address = ip_address(host_address(host))
+    if address.version == 4:
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (str(address), 0))]
+    return [(socket.AF_INET6, socket.SOCK_STREAM, 6, "", (str(address), 0, 0, 0))]
+
+
+def run_scanner(arguments):
+    """Run snmp-scan.py in this process with the stand-in resolver"""
+    socket.getnameinfo = fake_getnameinfo
+    socket.getaddrinfo = fake_getaddrinfo
+    # without dnspython snmp-scan.py uses the system resolver, which is faked here
+    sys.modules["dns"] = None
+    sys.modules["dns.asyncresolver"] = None
+
+    sys.argv = [SCANNER] + arguments
+    runpy.run_path(SCANNER, run_name="__main__")
+
+
+#############
+# Benchmark #
+#############
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values"""
+    return values[max(0, -(-len(values) * percent // 100) - 1)]
+
+
+def process_tree_rss(pid):
+    """Total RSS in bytes of pid and all its descendants, read from /proc"""
+    children = {}
+    for entry in listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as stat:
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue  # exited in the meantime
+        children.setdefault(parent, []).append(int(entry))
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending += children.get(current, [])
+        try:
+            with open("/proc/{}/statm".format(current)) as statm:
+                total += int(statm.read().split()[1]) * PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            pass
+    return total
+
+
+def run_measured(command, interval=0.1):
+    """Run command and return (exit code, peak RSS in MB of it and its children)"""
+    process = Popen(command, stdout=DEVNULL)
+    peak_rss = 0
+    if path.isdir("/proc"):
+        while process.poll() is None:
+            peak_rss = max(peak_rss, process_tree_rss(process.pid))
+            sleep(interval)
+    else:
+        # without /proc only the largest of the waited for processes is known
+        process.wait()
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+    return process.returncode, peak_rss / 1024 / 1024
+
+
+def report(results_file, runtime, peak_rss):
+    latencies = {}
+    stats = {}
+    with open(results_file) as records:
+        for line in records:
+            record = json.loads(line)
+            if record["type"] == "result":
+                latencies.setdefault(record["outcome"], []).append(
+                    sum(record["timings"].values())
+                )
+            elif record["type"] == "stats":
+                stats = record
+
+    print(
+        "Scanned {} IPs in {:.2f} seconds: {:.1f} hosts/s, peak RSS {:.1f} MB".format(
+            stats.get("count", 0),
+            runtime,
+            stats.get("count", 0) / runtime,
+            peak_rss,
+        )
+    )
+    print(
+        "{:<12} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+            "outcome", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"
+        )
+    )
+    for outcome, values in sorted(latencies.items()):
+        values.sort()
+        print(
+            "{:<12} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                outcome,
+                len(values),
+                *(percentile(values, percent) * 1000 for percent in (50, 90, 99)),
+                values[-1] * 1000,
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark snmp-scan.py with a stand-in for lnms device:add and DNS.",
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "network",
+        nargs="*",
+        default=["198.18.0.0/16"],
+        help="Synthetic networks to scan. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--added",
+        type=float,
+        default=0.02,
+        help="Share of IPs device:add adds, exit code 0. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--known",
+        type=float,
+        default=0.02,
+        help="Share of IPs that are known devices, exit code 3. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--failed",
+        type=float,
+        default=0.01,
+        help="Share of IPs that fail to add, exit code 2. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--error",
+        type=float,
+        default=0.005,
+        help="Share of IPs that fail with an error, exit code 1. Default: %(default)s"
+        "\nAll other IPs do not ping, exit code 2.",
+    )
+    parser.add_argument(
+        "--add-latency",
+        type=float,
+        default=0.05,
+        metavar="SECONDS",
+        help="How long device:add takes for IPs that answer. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--down-latency",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="How long device:add takes for IPs that do not ping. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--dns-ratio",
+        type=float,
+        default=0.5,
+        help="Share of IPs with a reverse DNS record. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--dns-latency",
+        type=float,
+        default=0.002,
+        metavar="SECONDS",
+        help="How long each DNS lookup takes. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.5,
+        help="Random variation of all latencies, as a share of the latency. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--scan-args",
+        default="",
+        metavar="ARGS",
+        help="Extra arguments for snmp-scan.py, for example --scan-args='-t 64 --batch'",
+    )
+    args = parser.parse_args()
+
+    with TemporaryDirectory(prefix="snmp-scan-benchmark.") as workdir:
+        for name in ("lnms", "php"):
+            symlink(path.realpath(__file__), path.join(workdir, name))
+
+        results_file = path.join(workdir, "results.jsonl")
+        environ["PATH"] = workdir + ":" + environ["PATH"]
+        environ["SNMP_SCAN_BENCHMARK"] = json.dumps(
+            {
+                "added": args.added,
+                "known": args.known,
+                "failed": args.failed,
+                "error": args.error,
+                "add_latency": args.add_latency,
+                "down_latency": args.down_latency,
+                "dns_ratio": args.dns_ratio,
+                "dns_latency": args.dns_latency,
+                "jitter": args.jitter,
+                "config": {
+                    "nets": args.network,
+                    "autodiscovery": {"nets-exclude": []},
+                    "distributed_poller_group": "0",
+                    "log_dir": workdir,
+                    "snmp": {"community": ["public"], "version": ["v2c"]},
+                },
+            }
+        )
+
+        command = [sys.executable, path.realpath(__file__), "--run-scanner"]
+        command += ["--config-cache", "0", "--no-prefetch", "--output", "jsonl"]
+        command += ["--output-file", results_file] + shlex.split(args.scan_args)
+
+        started = monotonic()
+        returncode, peak_rss = run_measured(command)
+        runtime = monotonic() - started
+        if returncode:
+            sys.exit("snmp-scan.py failed with exit code {}".format(returncode))
+
+        report(results_file, runtime, peak_rss)
+
+
+if __name__ == "__main__":
+    role = path.basename(sys.argv[0])
+    if role == "lnms":
+        sys.exit(fake_lnms(sys.argv[1:]))
+    elif role == "php":
+        sys.exit(fake_php(sys.argv[1:]))
+    elif sys.argv[1:2] == ["--run-scanner"]:
+        run_scanner(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env php
+<?php
+
+/**
+ * snmp-scan-add.php
+ *
+ * Batch device add worker for snmp-scan.py --batch.
+ * Reads one hostname or IP per line from STDIN and writes one JSON object per line to STDOUT
+ * with the same status codes as lnms device:add, so a single PHP process can add many devices.
+ *
+ * Usage: ./snmp-scan-add.php [-g poller_group] [-b (ping fallback) | -P (ping only)]
+ *
+ * @link       https://www.librenms.org
+ */
+
+use App\Actions\Device\ValidateDeviceAndCreate;
+use App\Models\Device;
+use LibreNMS\Exceptions\HostExistsException;
+use LibreNMS\Exceptions\HostUnreachableException;
+
+$init_modules = [];
+require __DIR__ . '/includes/init.php';
+
+$options = getopt('g:bP');
+$poller_group = (int) ($options['g'] ?? 0);
+$ping_fallback = isset($options['b']);
+$ping_only = isset($options['P']);
+
+while (($line = fgets(STDIN)) !== false) {
+    $hostname = trim($line);
+    if ($hostname === '') {
+        continue;
+    }
+
+    $device = new Device([
+        'hostname' => $hostname,
+        'poller_group' => $poller_group,
+    ]);
+
+    if ($ping_only) {
+        $device->snmp_disable = 1;
+        $device->os = 'ping';
+    }
+
+    // status codes match lnms device:add
+    try {
+        if ((new ValidateDeviceAndCreate($device, false, $ping_fallback))->execute()) {
+            $status = 0;
+            $output = "Added device $device->hostname ($device->device_id)";
+        } else {
+            $status = 1;
+            $output = "Failed to add device $hostname";
+        }
+    } catch (HostUnreachableException $e) {
+        $status = 2;
+        $output = $e->getMessage() . PHP_EOL . implode(PHP_EOL, $e->getReasons());
+    } catch (HostExistsException $e) {
+        $status = 3;
+        $output = $e->getMessage();
+    } catch (Throwable $e) {
+        $status = 1;
+        $output = $e->getMessage();
+    }
+
+    fwrite(STDOUT, json_encode(['hostname' => $hostname, 'status' => $status, 'output' => $output]) . PHP_EOL);
+    fflush(STDOUT);
+}
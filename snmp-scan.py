@@ -22,148 +22,1918 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import argparse
+import asyncio
+import hashlib
 import json
-from collections import namedtuple
-from ipaddress import ip_network, ip_address
+import random
+import resource
+import sqlite3
+import sys
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import islice
+from ipaddress import ip_network, ip_address, IPv4Address, IPv6Address
+from math import ceil
 from multiprocessing import Pool
-from os import path, chdir
-from socket import gethostbyname, gethostbyaddr, herror, gaierror
-from subprocess import check_output, CalledProcessError
-from sys import stdout
-from time import time
+from os import path, chdir, fdopen, getenv, open as os_open, remove, replace
+from os import O_CREAT, O_TRUNC, O_WRONLY
+from queue import Queue
+from socket import NI_NAMEREQD, SOCK_STREAM
+from subprocess import check_output, CalledProcessError, Popen, PIPE
+from threading import Condition, Event, Lock, Thread
+from time import monotonic, sleep, time
+from uuid import uuid4
 
-Result = namedtuple("Result", ["ip", "hostname", "outcome", "output"])
+try:
+    from dns.asyncresolver import Resolver as AsyncResolver
+    from dns.exception import DNSException
+except ImportError:
+    AsyncResolver = None  # fall back to the system resolver, without record TTLs
+    DNSException = OSError
+
+Result = namedtuple(
+    "Result", ["ip", "hostname", "outcome", "output", "timings"], defaults=(None,)
+)
 args = {}
 
 
-class Outcome:
-    UNDEFINED = 0
-    ADDED = 1
-    UNPINGABLE = 2
-    KNOWN = 3
-    FAILED = 4
-    EXCLUDED = 5
-    TERMINATED = 6
-    NODNS = 7
-    ERROR = 8
+class Outcome:
+    UNDEFINED = 0
+    ADDED = 1
+    UNPINGABLE = 2
+    KNOWN = 3
+    FAILED = 4
+    EXCLUDED = 5
+    TERMINATED = 6
+    NODNS = 7
+    ERROR = 8
+    NORESPONSE = 9
+    DEADNET = 10
+    BACKOFF = 11
+
+
+class ExcludedRanges:
+    """
+    Sorted, merged address intervals built from autodiscovery.nets-exclude.
+    Lookups are a binary search, so the number of exclusions barely affects scan speed.
+    """
+
+    def __init__(self, networks=()):
+        self.starts = {4: [], 6: []}
+        self.ends = {4: [], 6: []}
+
+        for network in sorted(
+            networks, key=lambda n: (n.version, int(n.network_address))
+        ):
+            starts = self.starts[network.version]
+            ends = self.ends[network.version]
+            first = int(network.network_address)
+            last = int(network.broadcast_address)
+
+            if ends and first <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], last)  # overlapping or adjacent, merge
+            else:
+                starts.append(first)
+                ends.append(last)
+
+    def __contains__(self, ip):
+        starts = self.starts[ip.version]
+        index = bisect_right(starts, int(ip)) - 1
+        return index >= 0 and int(ip) <= self.ends[ip.version][index]
+
+    def split(self, version, first, last):
+        """
+        Split the inclusive integer range first-last into consecutive pieces.
+        Yields (start, end, excluded) tuples covering the whole range in order.
+        """
+        starts = self.starts[version]
+        ends = self.ends[version]
+        index = bisect_right(ends, first - 1)  # first interval ending at or after first
+
+        while first <= last:
+            if index < len(starts) and starts[index] <= first:
+                end = min(ends[index], last)
+                excluded = True
+                index += 1
+            else:
+                end = min(starts[index] - 1, last) if index < len(starts) else last
+                excluded = False
+
+            yield first, end, excluded
+            first = end + 1
+
+
+class Checkpoint:
+    """
+    Records how far a scan got so an interrupted scan can be resumed.
+    Addresses finish out of order, so the saved position is the first address that
+    has not finished yet, along with the outcomes of all addresses before it.
+    """
+
+    INTERVAL = 5  # seconds between writes
+
+    def __init__(self, filename, plan):
+        self.filename = filename
+        self.plan = plan
+        self.position = 0
+        self.issued = 0
+        self.stats = {"count": 0}
+        self.in_flight = {}  # ip -> sequence numbers
+        self.finished = {}  # sequence number -> outcome, for addresses past position
+        self.saved = monotonic()
+        self.lock = Lock()
+
+    def load(self):
+        with open(self.filename) as checkpoint_file:
+            data = json.load(checkpoint_file)
+
+        if data.get("plan") != self.plan:
+            raise ValueError(
+                "it was created for different networks, exclusions or IPv6 candidates"
+            )
+
+        self.position = self.issued = data["position"]
+        self.stats = {
+            int(key) if key.isdigit() else key: value
+            for key, value in data["stats"].items()
+        }
+
+    def save(self):
+        with self.lock:
+            data = {
+                "plan": self.plan,
+                "position": self.position,
+                "stats": {str(key): value for key, value in self.stats.items()},
+            }
+
+        with open(self.filename + ".tmp", "w") as checkpoint_file:
+            json.dump(data, checkpoint_file)
+        replace(self.filename + ".tmp", self.filename)
+        self.saved = monotonic()
+
+    def remove(self):
+        if path.exists(self.filename):
+            remove(self.filename)
+
+    def track(self, ips):
+        """Number the addresses from the scan source, skipping the ones already done"""
+        for ip in islice(ips, self.issued, None):
+            with self.lock:
+                self.in_flight.setdefault(ip, []).append(self.issued)
+                self.issued += 1
+            yield ip
+
+    def finish(self, ip, outcome):
+        with self.lock:
+            sequences = self.in_flight.get(ip)
+            if not sequences:
+                return
+            self.finished[sequences.pop(0)] = outcome
+            if not sequences:
+                del self.in_flight[ip]
+
+            while self.position in self.finished:
+                outcome = self.finished.pop(self.position)
+                self.stats[outcome] = self.stats.get(outcome, 0) + 1
+                self.stats["count"] += 1
+                self.position += 1
+
+        if monotonic() - self.saved > self.INTERVAL:
+            self.save()
+
+
+class TimingHistogram:
+    """Counts of stage durations in fixed, roughly logarithmic buckets"""
+
+    BUCKETS = [
+        0.001,
+        0.002,
+        0.005,
+        0.01,
+        0.02,
+        0.05,
+        0.1,
+        0.2,
+        0.5,
+        1,
+        2,
+        5,
+        10,
+        20,
+        60,
+    ]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # the last bucket is open ended
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the percentile, at most the maximum"""
+        rank = ceil(self.count * percent / 100)
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS + [self.max], self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "sum": round(self.total, 6),
+            "max": round(self.max, 6),
+            "buckets": {
+                str(bound): count
+                for bound, count in zip(self.BUCKETS + ["+Inf"], self.counts)
+                if count
+            },
+        }
+
+
+class ScanHistory:
+    """
+    Compact per address scan history in SQLite: the last outcome, when the address was
+    last scanned, last seen alive and last changed, and how many scans in a row found
+    nothing there. Outcomes are buffered and written in batches.
+    """
+
+    INTERVAL = 5  # seconds between writes
+    DEAD = (Outcome.UNPINGABLE, Outcome.NORESPONSE)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS history (ip BLOB PRIMARY KEY, outcome INTEGER,"
+            " scanned INTEGER, seen INTEGER, changed INTEGER, streak INTEGER) WITHOUT ROWID"
+        )
+        self.pending = {}
+        self.saved = monotonic()
+        self.lock = Lock()
+
+    def due(self, ip, now, backoff, max_backoff):
+        """
+        Addresses found dead are rechecked after backoff seconds, doubling with every
+        scan in a row that finds nothing, up to max_backoff. Addresses that were alive
+        before and went dead in the last scan are rechecked right away, so a device that
+        was briefly down is not left out for a whole backoff. Anything else is always due.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT scanned, seen, changed, streak FROM history WHERE ip = ?",
+                (ip_address(ip).packed,),
+            ).fetchone()
+
+        if not row or not row[3]:
+            return True
+        scanned, seen, changed, streak = row
+        if seen is not None and changed == scanned:
+            return True
+        return now - scanned >= min(backoff * 2 ** (streak - 1), max_backoff)
+
+    def record(self, ip, outcome):
+        with self.lock:
+            self.pending[ip_address(ip).packed] = (outcome, int(time()))
+
+        if monotonic() - self.saved > self.INTERVAL:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            rows = []
+            for packed, (outcome, scanned) in self.pending.items():
+                row = self.db.execute(
+                    "SELECT outcome, seen, changed, streak FROM history WHERE ip = ?",
+                    (packed,),
+                ).fetchone()
+                last_outcome, seen, changed, streak = row or (None, None, scanned, 0)
+                dead = outcome in self.DEAD
+                rows.append(
+                    (
+                        packed,
+                        outcome,
+                        scanned,
+                        seen if dead else scanned,
+                        changed if outcome == last_outcome else scanned,
+                        streak + 1 if dead else 0,
+                    )
+                )
+
+            self.db.executemany(
+                "INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            self.db.commit()
+            self.pending = {}
+            self.saved = monotonic()
+
+
+class DistributedScan:
+    """
+    Shares one scan between several pollers through a Redis work queue.
+    The first node to start splits the networks into chunks, then every node pulls
+    chunks until the queue is empty and adds its counts to a shared total.
+
+    Every node holds a lease it renews while it runs, which also keeps the scan alive.
+    The chunks a node is working on stay in its own list until it moves on, so when a
+    node dies its lease runs out, the other nodes put its chunks back in the queue and
+    do not wait for it. Once no node is left the scan expires, and the next run of the
+    same networks starts a new one.
+    """
+
+    EXPIRE = 86400
+    LEASE = 30  # seconds a node counts as alive after it last renewed its lease
+
+    def __init__(self, connection, plan):
+        self.redis = connection
+        self.job = "snmp-scan:" + plan
+        self.run = None
+        self.node = uuid4().hex
+        self.stopped = Event()
+
+    def key(self, name):
+        return "{}:{}:{}".format(self.job, self.run, name)
+
+    def join(self, ranges, chunk_size):
+        """Start or join the scan, only the node starting it iterates the ranges"""
+        while self.run is None:
+            run = uuid4().hex
+            if self.redis.set(self.job, run, nx=True, ex=self.LEASE):
+                self.run = run
+                self.start_lease()
+                self.enqueue(ranges, chunk_size)
+                break
+
+            self.run = self.redis.get(self.job)  # None if it just finished
+            # the scan is gone if the node starting it died before it was ready
+            while self.run and not self.redis.exists(self.key("ready")):
+                sleep(0.5)
+                if self.redis.get(self.job) != self.run:
+                    self.run = None
+            if self.run:
+                self.start_lease()
+
+    def start_lease(self):
+        self.renew_lease()
+        Thread(target=self.keep_lease, daemon=True).start()
+
+    def renew_lease(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self.key("alive:" + self.node), 1, ex=self.LEASE)
+        pipe.expire(self.job, self.LEASE)
+        pipe.sadd(self.key("nodes"), self.node)
+        pipe.expire(self.key("nodes"), self.EXPIRE)
+        pipe.execute()
+
+    def keep_lease(self):
+        while not self.stopped.wait(self.LEASE / 3):
+            try:
+                self.renew_lease()
+            except Exception as e:
+                debug("Could not renew the distributed scan lease: {}".format(e), 1)
+
+    def alive(self, node):
+        return self.redis.exists(self.key("alive:" + node))
+
+    def enqueue(self, ranges, chunk_size):
+        pipe = self.redis.pipeline(transaction=False)
+        queued = 0
+        for version, first, last in ranges:
+            for start in range(first, last + 1, chunk_size):
+                end = min(start + chunk_size - 1, last)
+                # pushed left and taken from the right, so chunks are scanned in order
+                pipe.lpush(self.key("queue"), "{}:{}:{}".format(version, start, end))
+                queued += 1
+                if queued % 1000 == 0:
+                    pipe.execute()
+
+        pipe.expire(self.key("queue"), self.EXPIRE)
+        pipe.set(self.key("ready"), queued, ex=self.EXPIRE)
+        pipe.execute()
+        debug("Queued {} chunks for distributed scan".format(queued), 1)
+
+    def ips(self):
+        """
+        Pull chunks from the queue as addresses are needed. Once it is empty, chunks of
+        dead nodes are taken over, and this waits for the nodes still working in case
+        they die before they are done.
+        """
+        working = self.key("working:" + self.node)
+        chunk = None
+        while True:
+            if chunk is not None:
+                self.redis.lrem(working, 1, chunk)
+
+            chunk = self.redis.rpoplpush(self.key("queue"), working)
+            if chunk is None:
+                if self.requeue_dead():
+                    continue
+                if self.others_working():
+                    sleep(1)
+                    continue
+                return
+
+            self.redis.expire(working, self.EXPIRE)
+            yield from iter_range_ips(*(int(part) for part in chunk.split(":")))
+
+    def requeue_dead(self):
+        """Put the chunks of nodes whose lease ran out back in the queue"""
+        requeued = 0
+        for node in self.redis.smembers(self.key("nodes")):
+            if node == self.node or self.alive(node):
+                continue
+            while self.redis.rpoplpush(self.key("working:" + node), self.key("queue")):
+                requeued += 1
+
+        if requeued:
+            debug("Took over {} chunks of dead pollers".format(requeued), 1)
+        return requeued
+
+    def others_working(self):
+        return any(
+            self.redis.llen(self.key("working:" + node)) and self.alive(node)
+            for node in self.redis.smembers(self.key("nodes"))
+            if node != self.node
+        )
+
+    def finish(self, node_stats, wait):
+        """
+        Add this node's counts to the total and wait up to wait seconds for the other
+        nodes that are still alive. Returns the merged counts and the number of nodes
+        that added theirs.
+        """
+        pipe = self.redis.pipeline()
+        for key, value in node_stats.items():
+            pipe.hincrby(self.key("stats"), str(key), value)
+        pipe.expire(self.key("stats"), self.EXPIRE)
+        pipe.sadd(self.key("done"), self.node)
+        pipe.expire(self.key("done"), self.EXPIRE)
+        pipe.execute()
+
+        deadline = monotonic() + wait
+        while monotonic() < deadline:
+            done = self.redis.smembers(self.key("done"))
+            running = [
+                node
+                for node in self.redis.smembers(self.key("nodes"))
+                if node not in done and self.alive(node)
+            ]
+            if not running:
+                break
+            sleep(1)
+
+        self.stopped.set()
+        self.redis.delete(self.key("alive:" + self.node))
+        if self.redis.get(self.job) == self.run:
+            self.redis.delete(
+                self.job
+            )  # allow the next scan of these networks to start
+
+        totals = {
+            int(key) if key.isdigit() else key: int(value)
+            for key, value in self.redis.hgetall(self.key("stats")).items()
+        }
+        return totals, self.redis.scard(self.key("done"))
+
+
+class ConcurrencyLimit:
+    """A semaphore whose size can be changed while it is in use"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.condition = Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def resize(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+
+class AdaptiveConcurrency(Thread):
+    """
+    Grows or shrinks a ConcurrencyLimit toward what the machine can handle.
+    The limit shrinks when the load average per CPU or free memory cross their thresholds,
+    or when scans take much longer than they used to, and grows while all slots are busy.
+    """
+
+    INTERVAL = 2  # seconds between adjustments
+    LATENCY_FACTOR = 3  # scans this much slower than the baseline mean overload
+
+    def __init__(self, limit, maximum, max_load, min_free_memory):
+        super().__init__(daemon=True)
+        import psutil
+
+        self.psutil = psutil
+        self.limit = limit
+        self.maximum = maximum
+        self.max_load = max_load
+        self.min_free_memory = min_free_memory * 1048576
+        self.latencies = []
+        self.baseline = None
+        self.lock = Lock()
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def run(self):
+        while True:
+            sleep(self.INTERVAL)
+            self.adjust()
+
+    def adjust(self):
+        with self.lock:
+            latencies, self.latencies = sorted(self.latencies), []
+
+        current = self.limit.limit
+        load = self.psutil.getloadavg()[0] / (self.psutil.cpu_count() or 1)
+        free_memory = self.psutil.virtual_memory().available
+
+        median = latencies[len(latencies) // 2] if latencies else None
+        if median is not None:
+            # the baseline follows the fastest period seen, drifting up slowly
+            self.baseline = min(median, (self.baseline or median) * 1.1)
+
+        if free_memory < self.min_free_memory or load > self.max_load:
+            new = int(current * 0.75)
+        elif median is not None and median > self.baseline * self.LATENCY_FACTOR:
+            new = int(current * 0.9)
+        elif self.limit.active >= current:
+            new = current + max(1, current // 8)
+        else:
+            return
+
+        new = max(1, min(new, self.maximum))
+        if new != current:
+            debug(
+                "Concurrency {} -> {} (load {:.2f}, {} MB free, median scan {}s)".format(
+                    current,
+                    new,
+                    load,
+                    free_memory // 1048576,
+                    "{:.2f}".format(median) if median is not None else "-",
+                ),
+                2,
+            )
+            self.limit.resize(new)
+
+
+class RateLimiter:
+    """
+    Limits how many probes per second go out overall and to each subnet.
+    reserve() books the next free slot in every bucket the address falls into and
+    returns how long to wait for it, so the caller can sleep without holding a lock.
+    Slots are spread evenly, bursts are not allowed.
+    """
+
+    MAX_SUBNETS = 4096
+
+    def __init__(self, rate, subnet_rate, subnet_size):
+        self.rate = rate
+        self.subnet_rate = subnet_rate
+        self.subnet_size = subnet_size
+        self.next_slot = {}  # bucket -> time of the next free slot
+        self.lock = Lock()
+
+    def reserve(self, ip):
+        buckets = []
+        if self.rate:
+            buckets.append(("all", self.rate))
+        if self.subnet_rate:
+            address = ip_address(ip)
+            subnet = (address.version, int(address) // self.subnet_size)
+            buckets.append((subnet, self.subnet_rate))
+
+        with self.lock:
+            now = monotonic()
+            start = max([now] + [self.next_slot.get(key, now) for key, _ in buckets])
+            for key, rate in buckets:
+                self.next_slot[key] = start + 1 / rate
+
+            if len(self.next_slot) > self.MAX_SUBNETS:
+                # subnets whose slot has passed are idle, forgetting them changes nothing
+                for key in [key for key, slot in self.next_slot.items() if slot < now]:
+                    del self.next_slot[key]
+
+        return start - now
+
+
+POLLER_GROUP = "0"
+VERBOSE_LEVEL = 0
+THREADS = 32
+CONFIG = {}
+EXCLUDED_NETS = []
+EXCLUDED_RANGES = ExcludedRanges()
+KNOWN_IPS = set()
+KNOWN_HOSTNAMES = set()
+NEIGHBORS = {}
+KNOWN_MACS = set()
+IPV6_HOSTS = []
+start_time = time()
+stats = {
+    "count": 0,
+    Outcome.ADDED: 0,
+    Outcome.UNPINGABLE: 0,
+    Outcome.KNOWN: 0,
+    Outcome.FAILED: 0,
+    Outcome.EXCLUDED: 0,
+    Outcome.TERMINATED: 0,
+    Outcome.NODNS: 0,
+    Outcome.ERROR: 0,
+    Outcome.NORESPONSE: 0,
+    Outcome.DEADNET: 0,
+    Outcome.BACKOFF: 0,
+}
+result_lock = Lock()
+results_file = None
+stage_timings = {}  # ip -> {stage: seconds} for stages run in the main process
+timing_histograms = {}  # stage -> outcome -> TimingHistogram
+event_loop = None
+dns_resolver = None
+rate_limiter = None
+checkpoint = None
+history = None
+dns_cache = {}
+DNS_CACHE_SIZE = 65536
+
+
+def debug(message, level=2):
+    if level <= VERBOSE_LEVEL:
+        print(message)
+
+
+def get_outcome_symbol(outcome):
+    return {
+        Outcome.UNDEFINED: "?",  # should not occur
+        Outcome.ADDED: "+",
+        Outcome.UNPINGABLE: ".",
+        Outcome.KNOWN: "*",
+        Outcome.FAILED: "-",
+        Outcome.TERMINATED: "",
+        Outcome.NODNS: "~",
+        Outcome.ERROR: "E",
+        Outcome.NORESPONSE: "_",
+        Outcome.BACKOFF: "",
+    }[outcome]
+
+
+def get_outcome_name(outcome):
+    return next(
+        name for name, value in vars(Outcome).items() if value == outcome
+    ).lower()
+
+
+def record_timing(ip, stage, seconds):
+    stage_timings.setdefault(ip, {})[stage] = seconds
+
+
+async def timed(stage, func, ip):
+    started = monotonic()
+    try:
+        return await func(ip)
+    finally:
+        record_timing(ip, stage, monotonic() - started)
+
+
+def write_json_record(record):
+    results_file.write(json.dumps(record) + "\n")
+    results_file.flush()
+
+
+def handle_result(data):
+    # results arrive from both the pool's result thread and the main thread
+    with result_lock:
+        timings = stage_timings.pop(data.ip, {})
+        timings.update(data.timings or {})
+
+        if data.outcome != Outcome.TERMINATED:
+            for stage, seconds in timings.items():
+                timing_histograms.setdefault(stage, {}).setdefault(
+                    data.outcome, TimingHistogram()
+                ).add(seconds)
+
+        if results_file:
+            write_json_record(
+                {
+                    "type": "result",
+                    "ip": data.ip,
+                    "hostname": data.hostname,
+                    "outcome": get_outcome_name(data.outcome),
+                    "output": data.output,
+                    "timings": {
+                        stage: round(seconds, 6) for stage, seconds in timings.items()
+                    },
+                }
+            )
+
+        if VERBOSE_LEVEL > 0:
+            print(
+                "Scanned \033[1m{}\033[0m {}".format(
+                    (
+                        "{} ({})".format(data.hostname, data.ip)
+                        if data.hostname
+                        else data.ip
+                    ),
+                    data.output,
+                )
+            )
+        else:
+            print(get_outcome_symbol(data.outcome), end="", flush=True)
+
+        # skipped IPs are only counted in the summary, like excluded ones
+        stats["count"] += (
+            0 if data.outcome in (Outcome.TERMINATED, Outcome.BACKOFF) else 1
+        )
+        stats[data.outcome] += 1
+
+        if checkpoint and data.outcome != Outcome.TERMINATED:
+            checkpoint.finish(data.ip, data.outcome)
+
+    if history and data.outcome not in (Outcome.TERMINATED, Outcome.BACKOFF):
+        history.record(data.ip, data.outcome)
+
+
+def format_seconds(seconds):
+    if seconds < 1:
+        return "{:.0f}ms".format(seconds * 1000)
+    return "{:.2f}s".format(seconds)
+
+
+def print_timings():
+    """Where the time went, per stage and outcome, to tell DNS, network and PHP bound scans apart"""
+    if not timing_histograms:
+        return
+
+    print("Time per stage:")
+    for stage, outcomes in timing_histograms.items():
+        total = sum(histogram.total for histogram in outcomes.values())
+        count = sum(histogram.count for histogram in outcomes.values())
+        print(
+            "  {}: {:.2f} seconds over {} IPs, {} on average".format(
+                stage, total, count, format_seconds(total / count)
+            )
+        )
+
+        for outcome, histogram in sorted(outcomes.items()):
+            print(
+                "    {:<11} {:>7} IPs  mean {:>7}  p50 {:>7}  p90 {:>7}  max {:>7}".format(
+                    get_outcome_name(outcome),
+                    histogram.count,
+                    format_seconds(histogram.total / histogram.count),
+                    format_seconds(histogram.percentile(50)),
+                    format_seconds(histogram.percentile(90)),
+                    format_seconds(histogram.max),
+                )
+            )
+            if VERBOSE_LEVEL > 0:
+                print(
+                    "      "
+                    + "  ".join(
+                        "<={}: {}".format(format_seconds(bound), count)
+                        for bound, count in zip(histogram.BUCKETS, histogram.counts)
+                        if count
+                    )
+                    + (
+                        "  >{}: {}".format(
+                            format_seconds(histogram.BUCKETS[-1]), histogram.counts[-1]
+                        )
+                        if histogram.counts[-1]
+                        else ""
+                    )
+                )
+
+
+def check_ip_excluded(check_ip):
+    if check_ip in EXCLUDED_RANGES:
+        debug(
+            "\033[91m{} excluded by autodiscovery.nets-exclude\033[0m".format(check_ip),
+            1,
+        )
+        stats[Outcome.EXCLUDED] += 1
+        return True
+    return False
+
+
+CONFIG_CACHE_FILE = "storage/framework/cache/snmp-scan-config.json"
+CONFIG_SOURCES = ["config.php", ".env"]
+CONFIG_KEYS = [
+    "nets",
+    "autodiscovery",
+    "snmp",
+    "distributed_poller_group",
+    "log_dir",
+    "db_host",
+    "db_port",
+    "db_user",
+    "db_pass",
+    "db_name",
+    "db_socket",
+    "redis_host",
+    "redis_port",
+    "redis_db",
+    "redis_pass",
+    "redis_socket",
+]
+
+
+def load_config(max_age):
+    """
+    Load the LibreNMS config. Dumping it boots PHP and Laravel, so the keys used here
+    are kept in a snapshot that is reused for max_age seconds, as long as config.php
+    and .env have not changed since it was taken. Settings stored in the database are
+    not checked, so the snapshot is only used when asked for.
+    """
+    sources_mtime = max(
+        (path.getmtime(source) for source in CONFIG_SOURCES if path.exists(source)),
+        default=0,
+    )
+
+    if max_age > 0:
+        try:
+            with open(CONFIG_CACHE_FILE) as cache_file:
+                cached = json.load(cache_file)
+            if (
+                cached["sources_mtime"] == sources_mtime
+                and 0 <= time() - cached["created"] < max_age
+            ):
+                debug("Using cached config from {}".format(CONFIG_CACHE_FILE), 2)
+                return cached["config"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    config = json.loads(
+        check_output(["/usr/bin/env", "php", "lnms", "config:get", "--dump"]).decode()
+    )
+
+    if max_age > 0:
+        snapshot = {
+            "sources_mtime": sources_mtime,
+            "created": time(),
+            "config": {key: config[key] for key in CONFIG_KEYS if key in config},
+        }
+        try:
+            # contains credentials, only readable by the owner
+            fd = os_open(
+                CONFIG_CACHE_FILE + ".tmp", O_WRONLY | O_CREAT | O_TRUNC, 0o600
+            )
+            with fdopen(fd, "w") as cache_file:
+                json.dump(snapshot, cache_file)
+            replace(CONFIG_CACHE_FILE + ".tmp", CONFIG_CACHE_FILE)
+        except OSError as e:
+            debug("Could not cache config: {}".format(e), 2)
+
+    return config
+
+
+def load_env():
+    """Load settings from the LibreNMS .env file, they take precedence over the config"""
+    try:
+        from dotenv import load_dotenv
+
+        load_dotenv(".env")
+    except ImportError:
+        pass
+
+
+def db_connect():
+    """Connect to the LibreNMS database"""
+    import pymysql
+
+    load_env()
+    settings = {
+        "host": getenv("DB_HOST", CONFIG.get("db_host", "localhost")),
+        "port": int(getenv("DB_PORT", CONFIG.get("db_port", 3306))),
+        "user": getenv("DB_USERNAME", CONFIG.get("db_user", "librenms")),
+        "password": getenv("DB_PASSWORD", CONFIG.get("db_pass", "")),
+        "database": getenv("DB_DATABASE", CONFIG.get("db_name", "librenms")),
+    }
+    socket = getenv("DB_SOCKET", CONFIG.get("db_socket"))
+    if socket:
+        settings["unix_socket"] = socket
+
+    return pymysql.connect(**settings)
+
+
+def redis_connect():
+    """Connect to the Redis server used by the distributed pollers"""
+    import redis
+
+    load_env()
+    settings = {
+        "db": int(getenv("REDIS_DB", CONFIG.get("redis_db", 0))),
+        "password": getenv("REDIS_PASSWORD", CONFIG.get("redis_pass")),
+        "decode_responses": True,
+    }
+    socket = getenv("REDIS_SOCKET", CONFIG.get("redis_socket"))
+    if socket:
+        return redis.Redis(unix_socket_path=socket, **settings)
+
+    return redis.Redis(
+        host=getenv("REDIS_HOST", CONFIG.get("redis_host", "localhost")),
+        port=int(getenv("REDIS_PORT", CONFIG.get("redis_port", 6379))),
+        **settings
+    )
+
+
+def load_known_devices():
+    """Fetch the hostnames and IPs of all existing devices once, so they can be skipped without running device:add"""
+    connection = db_connect()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT hostname, ip, overwrite_ip FROM devices")
+            for hostname, ip, overwrite_ip in cursor:
+                KNOWN_HOSTNAMES.add(hostname.lower())
+                if ip:
+                    KNOWN_IPS.add(bytes(ip))  # stored packed, like ip_address().packed
+                for address in (hostname, overwrite_ip):
+                    try:
+                        KNOWN_IPS.add(ip_address(address).packed)
+                    except ValueError:
+                        pass
+    finally:
+        connection.close()
+
+
+def load_known_macs():
+    """Fetch the MAC addresses LibreNMS has seen in ARP tables and on ports, for EUI-64 candidates"""
+    connection = db_connect()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT mac_address FROM ipv4_mac UNION SELECT ifPhysAddress FROM ports"
+            )
+            for (mac,) in cursor:
+                if mac and len(mac) == 12:
+                    KNOWN_MACS.add(mac.lower())
+    finally:
+        connection.close()
+
+
+def read_host_list(filename):
+    """Addresses from a file with one address per line, # starts a comment"""
+    addresses = []
+    with open(filename) as host_file:
+        for line in host_file:
+            line = line.split("#")[0].strip()
+            if line:
+                addresses.append(ip_address(line))
+    return addresses
+
+
+def known_result(scan_ip, hostname=None):
+    """Returns a KNOWN Result if the IP or hostname belongs to an existing device"""
+    if ip_address(scan_ip).packed in KNOWN_IPS:
+        return Result(
+            scan_ip, hostname, Outcome.KNOWN, "Already have host {}".format(scan_ip)
+        )
+    if hostname and hostname.lower() in KNOWN_HOSTNAMES:
+        return Result(
+            scan_ip, hostname, Outcome.KNOWN, "Already have host {}".format(hostname)
+        )
+    return None
+
+
+def skip_known_ips(ips):
+    for ip in ips:
+        result = known_result(ip)
+        if result:
+            handle_result(result)
+        else:
+            yield ip
+
+
+def skip_backed_off_ips(ips):
+    """Skip addresses found dead before until their next recheck is due"""
+    now = time()
+    backoff = args.backoff * 3600
+    max_backoff = args.max_backoff * 3600
+    for ip in ips:
+        if history.due(ip, now, backoff, max_backoff):
+            yield ip
+        else:
+            handle_result(
+                Result(ip, None, Outcome.BACKOFF, "Found dead before, recheck not due")
+            )
+
+
+def host_range(network):
+    """First and last address of network.hosts() as integers"""
+    first = int(network.network_address)
+    last = int(network.broadcast_address)
+
+    # /31, /32, /127 and /128 networks have no reserved addresses
+    if network.num_addresses > 2:
+        first += 1
+        if network.version == 4:
+            last -= 1  # ipv6 has no broadcast address
+
+    return first, last
+
+
+def get_event_loop():
+    """
+    The event loop shared by all asynchronous stages. It runs in a thread of its own, so
+    lookups and probes in flight go on while the main thread waits for the pool, and
+    their timings are not stretched by that wait.
+    """
+    global event_loop
+    if event_loop is None:
+        event_loop = asyncio.new_event_loop()
+        # the system resolver fallback runs in the default executor
+        event_loop.set_default_executor(ThreadPoolExecutor(args.dns_concurrency))
+        Thread(target=event_loop.run_forever, daemon=True).start()
+    return event_loop
+
+
+def async_map(func, items, limit):
+    """
+    Run the coroutine function func over items with at most limit running at once.
+    Items are pulled lazily and (item, result) tuples are yielded as they complete.
+    """
+    loop = get_event_loop()
+
+    async def run(item):
+        return item, await func(item)
+
+    items = iter(items)
+    pending = set()
+    try:
+        while True:
+            for item in items:
+                pending.add(asyncio.run_coroutine_threadsafe(run(item), loop))
+                if len(pending) >= limit:
+                    break
+
+            if not pending:
+                return
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+##################
+# SNMP pre-probe #
+##################
+
+SNMP_PROBE_OIDS = ["1.3.6.1.2.1.1.2.0", "1.3.6.1.2.1.1.5.0"]  # sysObjectID, sysName
+IP_NET_TO_PHYSICAL_PHYS_ADDRESS = "1.3.6.1.2.1.4.35.1.4"
+IP_NET_TO_MEDIA_PHYS_ADDRESS = "1.3.6.1.2.1.4.22.1.2"  # ipv4 only, for older agents
+SNMP_WALK_REPETITIONS = 32
+
+
+def ber_encode(tag, value):
+    length = len(value)
+    if length < 0x80:
+        return bytes([tag, length]) + value
+    octets = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes([tag, 0x80 | len(octets)]) + octets + value
+
+
+def ber_integer(value):
+    return ber_encode(
+        0x02, value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True)
+    )
+
+
+def ber_oid(oid):
+    numbers = [int(number) for number in oid.split(".")]
+    encoded = bytes([numbers[0] * 40 + numbers[1]])
+    for number in numbers[2:]:
+        chunk = [number & 0x7F]
+        number >>= 7
+        while number:
+            chunk.append(0x80 | (number & 0x7F))
+            number >>= 7
+        encoded += bytes(reversed(chunk))
+    return ber_encode(0x06, encoded)
+
+
+def ber_decode(data):
+    """Decode BER data into a list of (tag, value), constructed values are decoded recursively"""
+    decoded = []
+    offset = 0
+    while offset < len(data):
+        tag = data[offset]
+        length = data[offset + 1]
+        offset += 2
+        if length & 0x80:
+            size = length & 0x7F
+            length = int.from_bytes(data[offset : offset + size], "big")
+            offset += size
+        if offset + length > len(data):
+            raise ValueError("Truncated BER data")
+        value = data[offset : offset + length]
+        offset += length
+        decoded.append((tag, ber_decode(value) if tag & 0x20 else value))
+    return decoded
+
+
+def ber_decode_oid(value):
+    numbers = [value[0] // 40, value[0] % 40]
+    number = 0
+    for byte in value[1:]:
+        number = (number << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            numbers.append(number)
+            number = 0
+    return ".".join(str(number) for number in numbers)
+
+
+def snmp_get_message(
+    version, community, request_id, oids, pdu_type=0xA0, repetitions=0
+):
+    """
+    SNMPv1/v2c GetRequest, GetNextRequest with pdu_type 0xA1 or
+    GetBulkRequest with pdu_type 0xA5 and max-repetitions repetitions
+    """
+    varbinds = b"".join(
+        ber_encode(0x30, ber_oid(oid) + ber_encode(0x05, b"")) for oid in oids
+    )
+    pdu = ber_encode(
+        pdu_type,
+        ber_integer(request_id)
+        + ber_integer(0)
+        + ber_integer(repetitions)
+        + ber_encode(0x30, varbinds),
+    )
+    return ber_encode(
+        0x30,
+        ber_integer(0 if version == "v1" else 1)
+        + ber_encode(0x04, community.encode())
+        + pdu,
+    )
+
+
+def snmpv3_discovery_message(message_id):
+    """
+    Unauthenticated SNMPv3 engine discovery request.
+    Every SNMPv3 agent answers it with a report, no matter which credentials it accepts.
+    """
+    header = ber_encode(
+        0x30,
+        ber_integer(message_id)
+        + ber_integer(65507)
+        + ber_encode(0x04, b"\x04")  # reportable, noAuthNoPriv
+        + ber_integer(3),  # USM
+    )
+    security = ber_encode(
+        0x04,
+        ber_encode(
+            0x30,
+            ber_encode(0x04, b"")
+            + ber_integer(0)
+            + ber_integer(0)
+            + ber_encode(0x04, b"") * 3,
+        ),
+    )
+    pdu = ber_encode(
+        0xA0,
+        ber_integer(message_id)
+        + ber_integer(0)
+        + ber_integer(0)
+        + ber_encode(0x30, b""),
+    )
+    scoped_pdu = ber_encode(0x30, ber_encode(0x04, b"") * 2 + pdu)
+    return ber_encode(0x30, ber_integer(3) + header + security + scoped_pdu)
+
+
+def parse_snmp_reply(data):
+    """Returns (request id, [(oid, (tag, value)), ...]) or None if data is not an SNMP message"""
+    try:
+        message = ber_decode(data)[0][1]
+        if int.from_bytes(message[0][1], "big") == 3:
+            # the scoped pdu may be encrypted, the message id is enough to match it
+            return int.from_bytes(message[1][1][0][1], "big", signed=True), []
+
+        pdu = message[2][1]
+        varbinds = [
+            (ber_decode_oid(varbind[1][0][1]), varbind[1][1]) for varbind in pdu[3][1]
+        ]
+        return int.from_bytes(pdu[0][1], "big", signed=True), varbinds
+    except (IndexError, ValueError, TypeError):
+        return None
+
+
+def snmp_probe_messages():
+    """One request per configured snmp version and credential, keyed by request id"""
+    snmp_config = CONFIG.get("snmp", {})
+    messages = {}
+    for version in snmp_config.get("version", ["v2c", "v3", "v1"]):
+        if version == "v3":
+            if snmp_config.get("v3"):
+                request_id = random.getrandbits(31)
+                messages[request_id] = snmpv3_discovery_message(request_id)
+        else:
+            for community in snmp_config.get("community", ["public"]):
+                request_id = random.getrandbits(31)
+                messages[request_id] = snmp_get_message(
+                    version, community, request_id, SNMP_PROBE_OIDS
+                )
+    return messages
+
+
+class SnmpProbeProtocol(asyncio.DatagramProtocol):
+    def __init__(self, request_ids, future):
+        self.request_ids = request_ids
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        reply = parse_snmp_reply(data)
+        if reply and reply[0] in self.request_ids and not self.future.done():
+            self.future.set_result(reply)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+async def rate_limited(func, ip):
+    """Await func(ip) once --rate and --subnet-rate allow a probe to ip"""
+    if rate_limiter:
+        await asyncio.sleep(rate_limiter.reserve(ip))
+    return await func(ip)
+
+
+async def snmp_request(ip):
+    """
+    Send SNMP GETs for sysObjectID and sysName with every configured credential.
+    Returns the varbinds of the first reply. Raises asyncio.TimeoutError if nothing
+    answered and OSError (ConnectionRefusedError for port unreachable) on ICMP errors.
+    """
+    request_id, varbinds = await snmp_send(ip, snmp_probe_messages())
+    return varbinds
+
+
+async def snmp_send(ip, messages):
+    """
+    Send all messages, keyed by request id, with retries until one is answered.
+    Returns (request id, varbinds) of the first reply.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: SnmpProbeProtocol(messages, future),
+        remote_addr=(ip, CONFIG.get("snmp", {}).get("port", 161)),
+    )
+
+    try:
+        for attempt in range(args.probe_retries + 1):
+            for message in messages.values():
+                transport.sendto(message)
+            try:
+                return await asyncio.wait_for(
+                    asyncio.shield(future), args.probe_timeout
+                )
+            except asyncio.TimeoutError:
+                if attempt == args.probe_retries:
+                    raise
+    finally:
+        transport.close()
+
+
+async def snmp_probe(ip):
+    """Returns None if the host should be handed to device:add, otherwise a Result"""
+    try:
+        varbinds = await snmp_request(ip)
+    except asyncio.TimeoutError:
+        return Result(ip, None, Outcome.NORESPONSE, "No response to SNMP probe")
+    except ConnectionRefusedError:
+        # icmp port unreachable, the host is up but not running an snmp agent
+        return Result(ip, None, Outcome.NORESPONSE, "SNMP port unreachable")
+    except OSError as e:
+        return Result(ip, None, Outcome.NORESPONSE, "SNMP probe failed: {}".format(e))
+
+    for oid, value in varbinds:
+        if oid == SNMP_PROBE_OIDS[1] and value[0] == 0x04:
+            debug("{} sysName: {}".format(ip, value[1].decode(errors="replace")), 2)
+    return None
+
+
+async def snmp_alive(ip):
+    """An SNMP reply or an ICMP port unreachable both show the host is up"""
+    try:
+        await snmp_request(ip)
+        return True
+    except ConnectionRefusedError:
+        return True
+    except (asyncio.TimeoutError, OSError):
+        return False
+
+
+def snmp_probe_ips(ips):
+    """Pre-probe addresses concurrently and only pass on the ones worth adding"""
+    # the wait for the rate limit is not part of the probe time
+    probe = partial(rate_limited, partial(timed, "probe", snmp_probe))
+    for ip, result in async_map(probe, ips, args.probe_concurrency):
+        if result:
+            handle_result(result)
+        else:
+            yield ip
+
+
+def oid_key(oid):
+    return tuple(int(number) for number in oid.split("."))
+
+
+async def snmp_walk(ip, version, community, oid):
+    """Yield (oid, (tag, value)) below oid, with GETBULK for v2c and GETNEXT for v1"""
+    current = oid
+    while True:
+        request_id = random.getrandbits(31)
+        if version == "v1":
+            message = snmp_get_message(version, community, request_id, [current], 0xA1)
+        else:
+            message = snmp_get_message(
+                version, community, request_id, [current], 0xA5, SNMP_WALK_REPETITIONS
+            )
+
+        _, varbinds = await snmp_send(ip, {request_id: message})
+        if not varbinds:
+            return
+
+        for name, value in varbinds:
+            # endOfMibView, left the subtree or an agent not moving forward (v1 errors)
+            if (
+                value[0] == 0x82
+                or not name.startswith(oid + ".")
+                or oid_key(name) <= oid_key(current)
+            ):
+                return
+            yield name, value
+            current = name
+
+
+async def walk_neighbors(ip, version, community):
+    """ip -> mac of the neighbor table entries of a device"""
+    neighbors = {}
+
+    async for name, value in snmp_walk(
+        ip, version, community, IP_NET_TO_PHYSICAL_PHYS_ADDRESS
+    ):
+        # indexed by ifIndex, address type, address length and the address octets
+        index = oid_key(name[len(IP_NET_TO_PHYSICAL_PHYS_ADDRESS) + 1 :])
+        if index[1] in (1, 2) and len(index) == index[2] + 3 and value[1]:
+            neighbors[str(ip_address(bytes(index[3:])))] = value[1].hex(":")
+
+    if not neighbors:
+        async for name, value in snmp_walk(
+            ip, version, community, IP_NET_TO_MEDIA_PHYS_ADDRESS
+        ):
+            # indexed by ifIndex and the ipv4 address
+            index = oid_key(name[len(IP_NET_TO_MEDIA_PHYS_ADDRESS) + 1 :])
+            if len(index) == 5 and value[1]:
+                neighbors[str(ip_address(bytes(index[1:])))] = value[1].hex(":")
+
+    return neighbors
+
+
+async def seed_neighbors(seed):
+    """Read the neighbor table of a seed device with the first v1/v2c credential that works"""
+    snmp_config = CONFIG.get("snmp", {})
+    for version in snmp_config.get("version", ["v2c", "v3", "v1"]):
+        if version == "v3":
+            continue  # the probe only speaks unauthenticated v3
+
+        for community in snmp_config.get("community", ["public"]):
+            try:
+                return await walk_neighbors(seed, version, community)
+            except asyncio.TimeoutError:
+                continue
+            except OSError as e:
+                debug("Could not walk {}: {}".format(seed, e), 1)
+                return {}
+
+    debug("\033[91mNo SNMP response from seed {}\033[0m".format(seed), 1)
+    return {}
+
+
+def iter_seed_ranges(networks, seeds):
+    """
+    Yield single address ranges for every neighbor the seed devices know of within
+    the networks, so only addresses that are actually in use get scanned.
+    """
+    for seed, neighbors in async_map(seed_neighbors, seeds, args.probe_concurrency):
+        debug("{} neighbors learned from {}".format(len(neighbors), seed), 1)
+        NEIGHBORS.update(neighbors)
+
+    host_ranges = [
+        (network.version, *host_range(network))
+        for network in networks
+        if not sparse_network(network)
+    ]
+    for ip in sorted(map(ip_address, NEIGHBORS), key=lambda ip: (ip.version, ip)):
+        if not any(
+            ip.version == version and first <= int(ip) <= last
+            for version, first, last in host_ranges
+        ):
+            continue
+        if check_ip_excluded(ip):
+            continue
+        yield ip.version, int(ip), int(ip)
+
+    for network in filter(sparse_network, networks):
+        yield from iter_ipv6_ranges(network)
+
+
+##################
+# DNS resolution #
+##################
+
+
+def get_dns_resolver():
+    global dns_resolver
+    if dns_resolver is None:
+        dns_resolver = AsyncResolver()
+        dns_resolver.lifetime = args.dns_timeout
+    return dns_resolver
+
+
+async def cached_lookup(key, lookup):
+    """
+    Return the cached value for key or await lookup(), which returns (value, ttl).
+    Failed lookups are cached for the default TTL, timeouts are not cached.
+    """
+    now = monotonic()
+    entry = dns_cache.get(key)
+    if entry and entry[0] > now:
+        return entry[1]
+
+    try:
+        value, ttl = await asyncio.wait_for(lookup(), args.dns_timeout)
+    except asyncio.TimeoutError:
+        return None
+    except (DNSException, OSError, UnicodeError):
+        value, ttl = None, args.dns_cache_ttl
+
+    dns_cache.pop(key, None)
+    if len(dns_cache) >= DNS_CACHE_SIZE:
+        del dns_cache[next(iter(dns_cache))]  # drop the oldest entry
+    dns_cache[key] = (now + ttl, value)
+    return value
+
+
+async def lookup_ptr(scan_ip):
+    if AsyncResolver:
+        answer = await get_dns_resolver().resolve_address(scan_ip)
+        return answer[0].target.to_text(omit_final_dot=True), answer.rrset.ttl
+
+    loop = asyncio.get_running_loop()
+    hostname, _ = await loop.getnameinfo((scan_ip, 0), NI_NAMEREQD)
+    return hostname, args.dns_cache_ttl
+
+
+async def lookup_addresses(hostname):
+    if AsyncResolver:
+        addresses = set()
+        ttls = []
+        for rdtype in ("A", "AAAA"):
+            try:
+                answer = await get_dns_resolver().resolve(hostname, rdtype)
+            except DNSException:
+                continue
+            addresses.update(ip_address(record.to_text()) for record in answer)
+            ttls.append(answer.rrset.ttl)
+        return addresses, min(ttls, default=args.dns_cache_ttl)
+
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(hostname, None, type=SOCK_STREAM)
+    return {ip_address(info[4][0].split("%")[0]) for info in infos}, args.dns_cache_ttl
+
+
+async def resolve_hostname(scan_ip):
+    """Reverse resolve scan_ip, the name is only used if it forward resolves back to scan_ip"""
+    hostname = await cached_lookup(("PTR", scan_ip), lambda: lookup_ptr(scan_ip))
+    if not hostname:
+        return None
+
+    addresses = await cached_lookup(
+        ("ADDR", hostname.lower()), lambda: lookup_addresses(hostname)
+    )
+    if addresses and ip_address(scan_ip) in addresses:  # check that forward resolves
+        return hostname
+
+    return None
+
+
+def resolve_ips(ips):
+    """Resolve many addresses concurrently, yielding (ip, hostname) for hosts to add"""
+    resolve = partial(timed, "dns", resolve_hostname)
+    for scan_ip, hostname in async_map(resolve, ips, args.dns_concurrency):
+        if args.dns and not hostname:
+            handle_result(Result(scan_ip, hostname, Outcome.NODNS, "DNS not Resolved"))
+            continue
+
+        known = known_result(scan_ip, hostname)
+        if known:
+            handle_result(known)
+            continue
+
+        yield scan_ip, hostname
+
+
+def device_add_result(scan_ip, hostname, returncode, output):
+    """Map a device:add exit code and output to a Result"""
+    if returncode == 0:
+        return Result(scan_ip, hostname, Outcome.ADDED, output)
+    elif returncode == 2:
+        if "Could not ping" in output:
+            return Result(scan_ip, hostname, Outcome.UNPINGABLE, output)
+        else:
+            return Result(scan_ip, hostname, Outcome.FAILED, output)
+    elif returncode == 3:
+        return Result(scan_ip, hostname, Outcome.KNOWN, output)
+    elif returncode == 1:
+        return Result(scan_ip, hostname, Outcome.ERROR, output)
+
+    return Result(scan_ip, hostname, Outcome.UNDEFINED, output)
+
+
+def device_add_arguments(scan_ip, hostname):
+    arguments = [
+        "/usr/bin/env",
+        "lnms",
+        "device:add",
+        "-g",
+        POLLER_GROUP,
+        hostname or scan_ip,
+    ]
+
+    if args.ping:
+        arguments.insert(5, args.ping)
+    return arguments
+
+
+def scan_host(scan_ip, hostname):
+    started = monotonic()
+    try:
+        add_output = check_output(device_add_arguments(scan_ip, hostname))
+
+        result = device_add_result(scan_ip, hostname, 0, add_output.decode().rstrip())
+    except CalledProcessError as err:
+        result = device_add_result(
+            scan_ip, hostname, err.returncode, err.output.decode().rstrip()
+        )
+    except KeyboardInterrupt:
+        return Result(scan_ip, hostname, Outcome.TERMINATED, "Terminated")
+
+    return result._replace(timings={"add": monotonic() - started})
+
+
+def start_batch_worker():
+    arguments = ["/usr/bin/env", "php", "snmp-scan-add.php", "-g", POLLER_GROUP]
+    if args.ping:
+        arguments.append(args.ping)
+
+    return Popen(arguments, stdin=PIPE, stdout=PIPE, text=True, bufsize=1)
+
+
+def scan_hosts_batch(hosts):
+    """
+    Register hosts through a few long-lived snmp-scan-add.php processes instead of
+    starting lnms device:add for every host, avoiding the PHP startup cost per device.
+    Each worker thread owns one PHP process and feeds it one host at a time.
+    """
+    queue = Queue(maxsize=args.batch * 2)
+
+    def worker():
+        process = None
+        while True:
+            host = queue.get()
+            if host is None:
+                break
+
+            scan_ip, hostname = host
+            started = monotonic()
+            try:
+                if process is None:
+                    process = start_batch_worker()
+                process.stdin.write((hostname or scan_ip) + "\n")
+                reply = json.loads(process.stdout.readline())
+                result = device_add_result(
+                    scan_ip, hostname, reply["status"], reply["output"].rstrip()
+                )
+            except (OSError, ValueError) as e:
+                # the php process died or could not be started, report this host and
+                # start a fresh one for the next
+                result = Result(
+                    scan_ip,
+                    hostname,
+                    Outcome.ERROR,
+                    "snmp-scan-add.php failed: {}".format(e),
+                )
+                if process:
+                    process.kill()
+                process = None
+
+            handle_result(result._replace(timings={"add": monotonic() - started}))
+
+        if process:
+            process.stdin.close()
+            process.wait()
+
+    workers = [Thread(target=worker, daemon=True) for _ in range(args.batch)]
+    for thread in workers:
+        thread.start()
+
+    for host in hosts:
+        if rate_limiter:
+            sleep(rate_limiter.reserve(host[0]))
+        queue.put(host)
+
+    for _ in workers:
+        queue.put(None)
+    for thread in workers:
+        thread.join()
 
 
-POLLER_GROUP = "0"
-VERBOSE_LEVEL = 0
-THREADS = 32
-CONFIG = {}
-EXCLUDED_NETS = []
-start_time = time()
-stats = {
-    "count": 0,
-    Outcome.ADDED: 0,
-    Outcome.UNPINGABLE: 0,
-    Outcome.KNOWN: 0,
-    Outcome.FAILED: 0,
-    Outcome.EXCLUDED: 0,
-    Outcome.TERMINATED: 0,
-    Outcome.NODNS: 0,
-    Outcome.ERROR: 0,
-}
+def sparse_network(network):
+    """IPv6 networks too large to sweep, only likely addresses in them are scanned"""
+    return network.version == 6 and network.num_addresses > args.ipv6_max
 
 
-def debug(message, level=2):
-    if level <= VERBOSE_LEVEL:
-        print(message)
+def eui64_interface_id(mac):
+    octets = bytes.fromhex(mac.replace(":", ""))
+    return int.from_bytes(
+        bytes([octets[0] ^ 0x02]) + octets[1:3] + b"\xff\xfe" + octets[3:], "big"
+    )
 
 
-def get_outcome_symbol(outcome):
-    return {
-        Outcome.UNDEFINED: "?",  # should not occur
-        Outcome.ADDED: "+",
-        Outcome.UNPINGABLE: ".",
-        Outcome.KNOWN: "*",
-        Outcome.FAILED: "-",
-        Outcome.TERMINATED: "",
-        Outcome.NODNS: "~",
-        Outcome.ERROR: "E",
-    }[outcome]
+def iter_ipv6_candidates(network):
+    """
+    Likely addresses in a large IPv6 network, most likely first: addresses learned from
+    neighbor tables and the host list, then the low-byte addresses (::1, ::2, ...) and
+    the EUI-64 addresses of all known MACs in each /64 that is known to be in use.
+    """
+    seen = [ip for ip in map(ip_address, NEIGHBORS) if ip in network] + [
+        ip for ip in IPV6_HOSTS if ip in network
+    ]
+    yield from map(int, seen)
 
+    if network.prefixlen >= 64:
+        prefixes = [int(network.network_address)]
+    else:
+        prefixes = sorted({int(ip) >> 64 << 64 for ip in seen})
+        prefixes = prefixes or [int(network.network_address)]
 
-def handle_result(data):
-    if VERBOSE_LEVEL > 0:
-        print(
-            "Scanned \033[1m{}\033[0m {}".format(
-                (
-                    "{} ({})".format(data.hostname, data.ip)
-                    if data.hostname
-                    else data.ip
-                ),
-                data.output,
-            )
+    # sorted, so the same MACs give the same candidates in every run
+    macs = sorted(KNOWN_MACS.union(NEIGHBORS.values()))
+    for prefix in prefixes:
+        yield from range(prefix + 1, prefix + args.ipv6_low_bytes + 1)
+        for mac in macs:
+            yield prefix | eui64_interface_id(mac)
+
+
+def iter_ipv6_ranges(network):
+    """Up to --ipv6-max candidates of a large IPv6 network, merged into ranges"""
+    first, last = host_range(network)
+    candidates = set()
+    for ip in iter_ipv6_candidates(network):
+        if len(candidates) >= args.ipv6_max:
+            break
+        if first <= ip <= last and ip not in candidates:
+            if not check_ip_excluded(IPv6Address(ip)):
+                candidates.add(ip)
+
+    debug("{} candidate addresses in {}".format(len(candidates), network), 1)
+
+    start = end = None
+    for ip in sorted(candidates):
+        if end is not None and ip == end + 1:
+            end = ip
+            continue
+        if start is not None:
+            yield 6, start, end
+        start = end = ip
+    if start is not None:
+        yield 6, start, end
+
+
+def iter_scan_ranges(networks):
+    """
+    Yield (version, first, last) integer ranges covering the addresses to scan.
+    Excluded blocks are cut out of each network up front and skipped as a whole.
+    """
+    for network in networks:
+        if sparse_network(network):
+            yield from iter_ipv6_ranges(network)
+            continue
+
+        address = IPv4Address if network.version == 4 else IPv6Address
+        first, last = host_range(network)
+
+        for start, end, excluded in EXCLUDED_RANGES.split(network.version, first, last):
+            if excluded:
+                debug(
+                    "\033[91m{} - {} excluded by autodiscovery.nets-exclude\033[0m".format(
+                        address(start), address(end)
+                    ),
+                    1,
+                )
+                stats[Outcome.EXCLUDED] += end - start + 1
+                continue
+
+            yield network.version, start, end
+
+
+def iter_range_ips(version, first, last):
+    address = IPv4Address if version == 4 else IPv6Address
+    for ip in range(first, last + 1):
+        yield str(address(ip))
+
+
+def iter_scan_ips(ranges):
+    """Lazily yield every address in the given ranges"""
+    for scan_range in ranges:
+        yield from iter_range_ips(*scan_range)
+
+
+def iter_subnet_blocks(ranges, size):
+    """Split ranges along subnet boundaries of size addresses"""
+    for version, first, last in ranges:
+        while first <= last:
+            end = min(first - first % size + size - 1, last)
+            yield version, first, end
+            first = end + 1
+
+
+async def check_subnet(block):
+    """Returns how many of a few sampled addresses in the block show signs of life"""
+    version, first, last = block
+    address = IPv4Address if version == 4 else IPv6Address
+
+    # the first and last addresses are the usual gateway addresses
+    samples = {first, last}
+    sampler = random.Random(first)
+    while len(samples) < min(args.subnet_samples, last - first + 1):
+        samples.add(sampler.randint(first, last))
+
+    replies = await asyncio.gather(
+        *(rate_limited(snmp_alive, str(address(ip))) for ip in samples)
+    )
+    return sum(replies)
+
+
+def interleave_subnets(blocks, width):
+    """
+    Round-robin over up to width subnet blocks at a time, so consecutive addresses
+    go to different subnets instead of working through one segment after another.
+    """
+    blocks = iter(blocks)
+    active = deque(iter_range_ips(*block) for block in islice(blocks, width))
+
+    while active:
+        ips = active.popleft()
+        ip = next(ips, None)
+        if ip is None:
+            block = next(blocks, None)
+            if block:
+                active.append(iter_range_ips(*block))
+            continue
+
+        yield ip
+        active.append(ips)
+
+
+def check_subnets(ranges):
+    """
+    Probe a sample of each subnet first, subnets without enough signs of life are
+    scanned last, or skipped entirely with --skip-dead-subnets.
+    """
+    dead = []
+    blocks = iter_subnet_blocks(ranges, 2 ** (32 - args.subnet_check))
+    limit = max(1, args.probe_concurrency // args.subnet_samples)
+
+    for block, alive in async_map(check_subnet, blocks, limit):
+        if alive >= args.subnet_min_alive:
+            yield block
+            continue
+
+        address = IPv4Address if block[0] == 4 else IPv6Address
+        debug(
+            "\033[91m{} - {} shows no signs of life\033[0m".format(
+                address(block[1]), address(block[2])
+            ),
+            1,
+        )
+        if args.skip_dead_subnets:
+            stats[Outcome.DEADNET] += block[2] - block[1] + 1
+        else:
+            dead.append(block)
+
+    yield from dead
+
+
+def scan_plan(networks):
+    """Identifies a scan by its networks and exclusions"""
+    plan = [[str(net) for net in networks], sorted(map(str, EXCLUDED_NETS))]
+    if any(sparse_network(network) for network in networks):
+        # which addresses of sparse networks are scanned depends on what is known
+        plan.append(
+            [
+                sorted(KNOWN_MACS.union(NEIGHBORS.values())),
+                sorted(map(str, IPV6_HOSTS)),
+                args.ipv6_max,
+                args.ipv6_low_bytes,
+            ]
+        )
+    return hashlib.sha1(json.dumps(plan).encode()).hexdigest()
+
+
+def scan_hosts(pool, hosts):
+    """
+    Feed (ip, hostname) pairs to the pool as workers free up instead of queueing them all at once.
+    At most twice the pool size is in flight, so memory use does not depend on the size
+    of the scanned networks and results are reported as soon as the first hosts finish.
+    In adaptive mode the number in flight is tuned to the machine, up to the pool size.
+    """
+    controller = None
+    if args.adaptive:
+        in_flight = ConcurrencyLimit(max(1, THREADS // 4))
+        controller = AdaptiveConcurrency(
+            in_flight, THREADS, args.max_load, args.min_free_memory
         )
+        controller.start()
     else:
-        print(get_outcome_symbol(data.outcome), end="")
-        stdout.flush()
+        in_flight = ConcurrencyLimit(THREADS * 2)
 
-    stats["count"] += 0 if data.outcome == Outcome.TERMINATED else 1
-    stats[data.outcome] += 1
+    for host in hosts:
+        if rate_limiter:
+            sleep(rate_limiter.reserve(host[0]))
+        in_flight.acquire()
+        started = monotonic()
 
+        def on_result(data, started=started):
+            try:
+                if controller:
+                    controller.record(monotonic() - started)
+                handle_result(data)
+            finally:
+                in_flight.release()
 
-def check_ip_excluded(check_ip):
-    for network_check in EXCLUDED_NETS:
-        if check_ip in network_check:
-            debug(
-                "\033[91m{} excluded by autodiscovery.nets-exclude\033[0m".format(
-                    check_ip
-                ),
-                1,
-            )
-            stats[Outcome.EXCLUDED] += 1
-            return True
-    return False
+        def on_error(err, host=host):
+            try:
+                handle_result(Result(*host, Outcome.ERROR, str(err)))
+            finally:
+                in_flight.release()
 
+        pool.apply_async(scan_host, host, callback=on_result, error_callback=on_error)
 
-def scan_host(scan_ip):
-    hostname = None
 
+async def scan_host_async(host):
+    """scan_host() for the async engine, device:add runs as an asyncio subprocess"""
+    scan_ip, hostname = host
+    if rate_limiter:
+        await asyncio.sleep(rate_limiter.reserve(scan_ip))
+
+    started = monotonic()
     try:
-        try:
-            # attempt to convert IP to hostname, if anything goes wrong, just use the IP
-            tmp = gethostbyaddr(scan_ip)[0]
-            if gethostbyname(tmp) == scan_ip:  # check that forward resolves
-                hostname = tmp
-        except (herror, gaierror):
-            pass
+        process = await asyncio.create_subprocess_exec(
+            *device_add_arguments(scan_ip, hostname), stdout=PIPE
+        )
+        add_output, _ = await process.communicate()
+    except OSError as e:
+        return Result(scan_ip, hostname, Outcome.ERROR, str(e))
 
-        try:
-            if args.dns and not hostname:
-                return Result(scan_ip, hostname, Outcome.NODNS, "DNS not Resolved")
-
-            arguments = [
-                "/usr/bin/env",
-                "lnms",
-                "device:add",
-                "-g",
-                POLLER_GROUP,
-                hostname or scan_ip,
-            ]
+    result = device_add_result(
+        scan_ip, hostname, process.returncode, add_output.decode().rstrip()
+    )
+    return result._replace(timings={"add": monotonic() - started})
 
-            if args.ping:
-                arguments.insert(5, args.ping)
-            add_output = check_output(arguments)
-
-            return Result(scan_ip, hostname, Outcome.ADDED, add_output)
-        except CalledProcessError as err:
-            output = err.output.decode().rstrip()
-            if err.returncode == 2:
-                if "Could not ping" in output:
-                    return Result(scan_ip, hostname, Outcome.UNPINGABLE, output)
-                else:
-                    return Result(scan_ip, hostname, Outcome.FAILED, output)
-            elif err.returncode == 3:
-                return Result(scan_ip, hostname, Outcome.KNOWN, output)
-            elif err.returncode == 1:
-                return Result(scan_ip, hostname, Outcome.ERROR, output)
-    except KeyboardInterrupt:
-        return Result(scan_ip, hostname, Outcome.TERMINATED, "Terminated")
 
-    return Result(scan_ip, hostname, Outcome.UNDEFINED, output)
+def scan_hosts_async(hosts):
+    """
+    Run device:add for up to -t hosts at a time from the event loop of the main process,
+    instead of a pool of worker processes. Every host in flight costs a child process
+    and a few pipes, not a Python worker, so -t can go into the thousands.
+    """
+    for _, result in async_map(scan_host_async, hosts, THREADS):
+        handle_result(result)
 
 
 if __name__ == "__main__":
@@ -192,6 +1962,14 @@ Example: 192.168.0.1/32 will be treated as a single host address""",
         help="How many IPs to scan at a time.  More will increase the scan speed,"
         + " but could overload your system. Default: {}".format(THREADS),
     )
+    parser.add_argument(
+        "--engine",
+        choices=["pool", "async"],
+        default="pool",
+        help="How to run device:add for -t IPs at a time. pool: a pool of -t worker"
+        " processes,\nasync: child processes driven from a single process, which allows"
+        " a -t in the thousands\nwith far less memory. Default: %(default)s",
+    )
     parser.add_argument(
         "-g",
         dest="group",
@@ -210,6 +1988,263 @@ Example: 192.168.0.1/32 will be treated as a single host address""",
         help="Only DNS resolved Devices",
     )
 
+    parser.add_argument(
+        "--snmp-probe",
+        dest="probe",
+        action="store_true",
+        help="Send a quick asynchronous SNMP request to each IP first and only run device:add"
+        " for IPs that answer.\nUses the communities and versions from the 'snmp' config, SNMPv3"
+        " agents are detected by engine discovery.\nCan not be used with --ping-fallback or"
+        " --ping-only, as hosts that answer ping\nbut drop SNMP would never reach device:add.",
+    )
+    parser.add_argument(
+        "--probe-concurrency",
+        type=int,
+        default=512,
+        help="How many SNMP probes to have in flight at a time. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--probe-timeout",
+        type=float,
+        help="Seconds to wait for an SNMP probe reply. Default: 'snmp.timeout' config or 1",
+    )
+    parser.add_argument(
+        "--probe-retries",
+        type=int,
+        default=1,
+        help="How many times to resend an unanswered SNMP probe. Default: %(default)s",
+    )
+
+    parser.add_argument(
+        "--seed",
+        action="append",
+        metavar="HOST",
+        help="Read the neighbor tables (ipNetToPhysicalTable, ARP and IPv6 ND) of HOST over SNMP"
+        "\nand only scan the neighbors within the networks. Can be given several times,"
+        "\nusually for the core routers. Uses the v1/v2c communities from the 'snmp' config.",
+    )
+
+    parser.add_argument(
+        "--ipv6-max",
+        type=int,
+        default=65536,
+        metavar="COUNT",
+        help="IPv6 networks with more addresses than COUNT are not swept, instead up to COUNT"
+        "\nlikely addresses are scanned: neighbors learned with --seed, --ipv6-hosts, low-byte"
+        "\naddresses and EUI-64 addresses of the MACs LibreNMS knows. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--ipv6-low-bytes",
+        type=int,
+        default=255,
+        metavar="COUNT",
+        help="How many low-byte addresses (::1, ::2, ...) to try in each IPv6 /64."
+        " Default: %(default)s",
+    )
+    parser.add_argument(
+        "--ipv6-hosts",
+        metavar="FILE",
+        help="File with known IPv6 addresses to scan in large IPv6 networks, one per line.",
+    )
+
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Adjust how many IPs are scanned at a time to the load, free memory and scan"
+        " times,\nstarting low and going up to -t. Use with a higher -t.",
+    )
+    parser.add_argument(
+        "--max-load",
+        type=float,
+        default=1.0,
+        help="Load average per CPU above which --adaptive scans less at a time."
+        " Default: %(default)s",
+    )
+    parser.add_argument(
+        "--min-free-memory",
+        type=int,
+        default=512,
+        metavar="MB",
+        help="Free memory below which --adaptive scans less at a time. Default: %(default)s",
+    )
+
+    parser.add_argument(
+        "--dns-concurrency",
+        type=int,
+        default=64,
+        help="How many DNS lookups to have in flight at a time. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--dns-timeout",
+        type=float,
+        default=2,
+        help="Seconds to wait for a DNS lookup. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--dns-cache-ttl",
+        type=int,
+        default=300,
+        help="Seconds to cache DNS answers and failures when the record TTL is unknown."
+        "\nRecord TTLs are used when dnspython is installed. Default: %(default)s",
+    )
+
+    parser.add_argument(
+        "--subnet-check",
+        type=int,
+        nargs="?",
+        const=24,
+        metavar="PREFIX",
+        help="Probe a few IPs of every /PREFIX subnet (/%(const)s if not given) before scanning,"
+        "\nsubnets without signs of life are scanned last. SNMP replies and ICMP port"
+        "\nunreachable count as signs of life. IPv6 subnets are split into blocks of the same size.",
+    )
+    parser.add_argument(
+        "--subnet-samples",
+        type=int,
+        default=4,
+        help="How many IPs to probe per subnet, including the first and last. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--subnet-min-alive",
+        type=int,
+        default=1,
+        help="How many sampled IPs must respond for a subnet to count as alive."
+        " Default: %(default)s",
+    )
+    parser.add_argument(
+        "--skip-dead-subnets",
+        action="store_true",
+        help="Skip subnets without signs of life instead of scanning them last.",
+    )
+
+    parser.add_argument(
+        "--rate",
+        type=float,
+        help="Maximum probes per second overall. A probe is an SNMP pre-probe or device:add run.",
+    )
+    parser.add_argument(
+        "--subnet-rate",
+        type=float,
+        help="Maximum probes per second to each /--rate-prefix subnet. IPs of several subnets"
+        "\nare scanned in turn, so no single segment gets a burst.",
+    )
+    parser.add_argument(
+        "--rate-prefix",
+        type=int,
+        default=24,
+        metavar="PREFIX",
+        help="Subnet size --subnet-rate applies to. Default: /%(default)s",
+    )
+
+    parser.add_argument(
+        "--batch",
+        type=int,
+        nargs="?",
+        const=4,
+        metavar="WORKERS",
+        help="Add devices through long-lived PHP processes (snmp-scan-add.php) instead of"
+        " starting lnms device:add for each IP.\nSpeeds up adding many devices at once."
+        " Default workers: %(const)s",
+    )
+
+    parser.add_argument(
+        "--output",
+        choices=["jsonl"],
+        help="Also write a JSON record for each scanned IP as it finishes, with its outcome"
+        "\nand time spent per stage, followed by a record with the totals.",
+    )
+    parser.add_argument(
+        "--output-file",
+        metavar="FILE",
+        default="-",
+        help="Where to write --output records. Default: stdout, moving other output to stderr",
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        nargs="?",
+        const="",
+        metavar="FILE",
+        help="Regularly save scan progress to FILE so it can be resumed with --resume."
+        "\nDefault: snmp-scan.checkpoint in the LibreNMS log directory",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted scan from its checkpoint file.",
+    )
+
+    parser.add_argument(
+        "--history",
+        nargs="?",
+        const="",
+        metavar="FILE",
+        help="Keep the last outcome of every scanned IP in FILE (SQLite), for --incremental."
+        "\nDefault: snmp-scan.history in the LibreNMS log directory",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Use the --history to only recheck IPs found dead before after a backoff, which"
+        "\ndoubles with every scan in a row that finds nothing. IPs that were alive, and"
+        "\nIPs that went dead in the last scan, are always scanned.",
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=20,
+        metavar="HOURS",
+        help="Time before the first recheck of an IP found dead. Default: %(default)s,"
+        " so a daily scan rechecks it",
+    )
+    parser.add_argument(
+        "--max-backoff",
+        type=float,
+        default=720,
+        metavar="HOURS",
+        help="Longest time between rechecks of an IP found dead. Default: %(default)s",
+    )
+
+    parser.add_argument(
+        "--distributed",
+        action="store_true",
+        help="Share the scan with snmp-scan.py running with the same networks on other pollers."
+        "\nNetworks are split into chunks in a Redis queue, each poller adds the devices"
+        "\nit finds to its own poller group and the totals of all pollers are printed.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=256,
+        help="How many IPs each distributed work item holds. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--distributed-wait",
+        type=int,
+        default=600,
+        help="Seconds to wait for other pollers to finish before printing the totals."
+        " Default: %(default)s",
+    )
+
+    parser.add_argument(
+        "--config-cache",
+        type=int,
+        default=0,
+        metavar="SECONDS",
+        help="Reuse the LibreNMS settings read by a previous run for up to SECONDS,"
+        "\nunless config.php or .env changed. Settings changed in the WebUI or with"
+        "\nlnms config:set are not noticed until the snapshot expires."
+        "\n0 always reads the config. Default: %(default)s",
+    )
+
+    parser.add_argument(
+        "--no-prefetch",
+        dest="prefetch",
+        action="store_false",
+        help="Do not load existing devices from the database up front."
+        "\nBy default known IPs and hostnames are skipped without running device:add.",
+    )
+
     parser.add_argument("-l", "--legend", action="store_true", help="Print the legend.")
     parser.add_argument(
         "-v",
@@ -256,18 +2291,31 @@ Example: 192.168.0.1/32 will be treated as a single host address""",
 
     args = parser.parse_args()
 
+    # block sizes are derived from IPv4 prefixes, IPv6 ranges use blocks of the same size
+    if args.subnet_check is not None and not 0 <= args.subnet_check <= 32:
+        parser.error("--subnet-check PREFIX must be between 0 and 32")
+    if args.subnet_samples < 1:
+        parser.error("--subnet-samples must be at least 1")
+    if not 0 <= args.subnet_min_alive <= args.subnet_samples:
+        parser.error("--subnet-min-alive must be between 0 and --subnet-samples")
+    if not 0 <= args.rate_prefix <= 32:
+        parser.error("--rate-prefix must be between 0 and 32")
+
     VERBOSE_LEVEL = args.verbose or VERBOSE_LEVEL
     THREADS = args.threads or THREADS
 
+    if args.output == "jsonl":
+        if args.output_file == "-":
+            results_file = sys.stdout
+            sys.stdout = sys.stderr  # keep the record stream clean
+        else:
+            results_file = open(args.output_file, "a")
+
     # Import LibreNMS config
     install_dir = path.dirname(path.realpath(__file__))
     chdir(install_dir)
     try:
-        CONFIG = json.loads(
-            check_output(
-                ["/usr/bin/env", "php", "lnms", "config:get", "--dump"]
-            ).decode()
-        )
+        CONFIG = load_config(args.config_cache)
     except CalledProcessError as e:
         parser.error(
             "Could not execute: {}\n{}".format(
@@ -280,6 +2328,45 @@ Example: 192.168.0.1/32 will be treated as a single host address""",
         args.group or str(CONFIG.get("distributed_poller_group")).split(",")[0]
     )
 
+    if args.prefetch:
+        try:
+            load_known_devices()
+            debug(
+                "Prefetched {} known IPs and {} hostnames".format(
+                    len(KNOWN_IPS), len(KNOWN_HOSTNAMES)
+                ),
+                2,
+            )
+        except Exception as e:
+            debug("Could not prefetch known devices: {}".format(e), 1)
+
+    if args.adaptive:
+        try:
+            import psutil  # noqa: F401
+        except ImportError:
+            parser.error("--adaptive requires the psutil module")
+
+    if args.engine == "async":
+        if args.adaptive or args.batch:
+            parser.error("--engine async can not be used with --adaptive or --batch")
+
+        # every device:add in flight holds a few pipes
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = (THREADS + args.probe_concurrency + args.dns_concurrency) * 4
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+            except (ValueError, OSError) as e:
+                debug("Could not raise the open file limit: {}".format(e), 1)
+
+    if args.probe and args.ping:
+        # the probe only passes on hosts that answer SNMP, the ping fallback would never be used
+        parser.error("--snmp-probe can not be used with --ping-fallback or --ping-only")
+    if args.probe_timeout is None:
+        args.probe_timeout = float(CONFIG.get("snmp", {}).get("timeout", 1))
+
     #######################
     # Build network lists #
     #######################
@@ -315,6 +2402,70 @@ Example: 192.168.0.1/32 will be treated as a single host address""",
             parser.error(
                 "Invalid excluded network format {}, check your config.php".format(e)
             )
+    EXCLUDED_RANGES = ExcludedRanges(EXCLUDED_NETS)
+
+    if any(sparse_network(network) for network in networks):
+        if args.ipv6_hosts:
+            try:
+                IPV6_HOSTS = read_host_list(args.ipv6_hosts)
+            except (OSError, ValueError) as e:
+                parser.error("Invalid --ipv6-hosts file: {}".format(e))
+        if args.prefetch:
+            try:
+                load_known_macs()
+                debug("Prefetched {} known MACs".format(len(KNOWN_MACS)), 2)
+            except Exception as e:
+                debug("Could not prefetch known MACs: {}".format(e), 1)
+
+    if args.seed and (
+        args.distributed
+        or args.subnet_check
+        or args.checkpoint is not None
+        or args.resume
+    ):
+        parser.error(
+            "--seed can not be used with --distributed, --subnet-check, --checkpoint or --resume"
+        )
+
+    if args.checkpoint is not None or args.resume:
+        # these change the order the addresses are scanned in between runs
+        if args.distributed or args.subnet_check or args.subnet_rate:
+            parser.error(
+                "--checkpoint and --resume can not be used with --distributed, --subnet-check"
+                " or --subnet-rate"
+            )
+
+        checkpoint = Checkpoint(
+            args.checkpoint
+            or path.join(CONFIG.get("log_dir", "logs"), "snmp-scan.checkpoint"),
+            scan_plan(networks),
+        )
+
+        if args.resume:
+            try:
+                checkpoint.load()
+            except (OSError, ValueError, KeyError) as e:
+                parser.error(
+                    "Can not resume from {}: {}".format(checkpoint.filename, e)
+                )
+            for key, value in checkpoint.stats.items():
+                stats[key] += value
+            print(
+                "Resuming after {} scanned IPs from {}".format(
+                    checkpoint.position, checkpoint.filename
+                )
+            )
+
+    if args.history is not None or args.incremental:
+        if args.incremental and args.distributed:
+            parser.error("--incremental can not be used with --distributed")
+        try:
+            history = ScanHistory(
+                args.history
+                or path.join(CONFIG.get("log_dir", "logs"), "snmp-scan.history")
+            )
+        except sqlite3.Error as e:
+            parser.error("Can not open scan history: {}".format(e))
 
     #################
     # Scan networks #
@@ -323,32 +2474,95 @@ Example: 192.168.0.1/32 will be treated as a single host address""",
 
     if args.legend and not VERBOSE_LEVEL:
         print(
-            "Legend:\n+  Added device\n*  Known device\n-  Failed to add device\n.  Ping failed\n~  Skipped due to no Reverse DNS\nE  Error when checking\n"
+            "Legend:\n+  Added device\n*  Known device\n-  Failed to add device\n.  Ping failed\n~  Skipped due to no Reverse DNS\n_  No SNMP response\nE  Error when checking\n"
         )
 
+    if args.rate or args.subnet_rate:
+        rate_limiter = RateLimiter(
+            args.rate, args.subnet_rate, 2 ** (32 - args.rate_prefix)
+        )
+
+    if args.seed:
+        ranges = iter_seed_ranges(networks, args.seed)
+    else:
+        ranges = iter_scan_ranges(networks)
+    if args.subnet_check:
+        ranges = check_subnets(ranges)
+
+    distributed = None
+    if args.distributed:
+        try:
+            distributed = DistributedScan(redis_connect(), scan_plan(networks))
+            distributed.join(ranges, args.chunk_size)
+        except Exception as e:
+            parser.error("Could not start distributed scan: {}".format(e))
+
     print("Scanning IPs:")
 
-    pool = Pool(processes=THREADS)
+    pool = None
 
     try:
-        for network in networks:
-            if network.num_addresses == 1:
-                ips = [ip_address(network.network_address)]
-            else:
-                ips = network.hosts()
+        if distributed:
+            ips = distributed.ips()
+        elif args.subnet_rate:
+            # as many subnets at a time as needed to reach the overall rate
+            width = ceil(args.rate / args.subnet_rate) * 2 if args.rate else 256
+            ips = interleave_subnets(
+                iter_subnet_blocks(ranges, 2 ** (32 - args.rate_prefix)),
+                min(max(width, 2), RateLimiter.MAX_SUBNETS),
+            )
+        else:
+            ips = iter_scan_ips(ranges)
+        if checkpoint:
+            ips = checkpoint.track(ips)
+        if args.incremental:
+            ips = skip_backed_off_ips(ips)
+        if KNOWN_IPS:
+            ips = skip_known_ips(ips)
+        if args.probe:
+            ips = snmp_probe_ips(ips)
+
+        hosts = resolve_ips(ips)
+
+        if args.batch:
+            scan_hosts_batch(hosts)
+        elif args.engine == "async":
+            scan_hosts_async(hosts)
+        else:
+            pool = Pool(processes=THREADS)
+            scan_hosts(pool, hosts)
 
-            for ip in ips:
-                if not check_ip_excluded(ip):
-                    pool.apply_async(scan_host, (str(ip),), callback=handle_result)
+            pool.close()
+            pool.join()
 
-        pool.close()
-        pool.join()
+        if checkpoint:
+            checkpoint.remove()
     except KeyboardInterrupt:
-        pool.terminate()
+        if pool:
+            pool.terminate()
+        if checkpoint:
+            checkpoint.save()
+            print(
+                "\nProgress saved to {}, continue with --resume".format(
+                    checkpoint.filename
+                )
+            )
+
+    if history:
+        history.save()
 
     if VERBOSE_LEVEL == 0:
         print("\n")
 
+    if distributed:
+        node_summary = "This poller scanned {} IPs, added {} devices".format(
+            stats["count"], stats[Outcome.ADDED]
+        )
+        totals, nodes = distributed.finish(stats, args.distributed_wait)
+        stats.update(totals)
+        print(node_summary)
+        print("Totals from {} pollers:".format(nodes))
+
     base = (
         "Scanned {} IPs: {} known devices, added {} devices, failed to add {} devices"
     )
@@ -364,6 +2578,16 @@ Example: 192.168.0.1/32 will be treated as a single host address""",
         summary += ", {} ips excluded due to missing reverse DNS record".format(
             stats[Outcome.NODNS]
         )
+    if stats[Outcome.DEADNET]:
+        summary += ", {} ips skipped in subnets without signs of life".format(
+            stats[Outcome.DEADNET]
+        )
+    if stats[Outcome.NORESPONSE]:
+        summary += ", {} ips did not respond to SNMP".format(stats[Outcome.NORESPONSE])
+    if stats[Outcome.BACKOFF]:
+        summary += ", {} ips found dead before were not due for a recheck".format(
+            stats[Outcome.BACKOFF]
+        )
     if stats[Outcome.ERROR]:
         summary += (
             ", {} errors while checking device (try with -v to see errors)".format(
@@ -373,3 +2597,25 @@ Example: 192.168.0.1/32 will be treated as a single host address""",
 
     print(summary)
     print("Runtime: {:.2f} seconds".format(time() - start_time))
+    print_timings()
+
+    if results_file:
+        write_json_record(
+            {
+                "type": "stats",
+                "count": stats["count"],
+                "outcomes": {
+                    get_outcome_name(outcome): count
+                    for outcome, count in stats.items()
+                    if outcome != "count"
+                },
+                "runtime": round(time() - start_time, 3),
+                "timings": {
+                    stage: {
+                        get_outcome_name(outcome): histogram.to_json()
+                        for outcome, histogram in outcomes.items()
+                    }
+                    for stage, outcomes in timing_histograms.items()
+                },
+            }
+        )